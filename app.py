@@ -2,9 +2,14 @@ from flask import Flask, request, jsonify, render_template, redirect, url_for, f
 import logging
 from databasemanager import DatabaseManager
 from rulebaseapp import RulebaseApp
+from indexmanager import IndexManager, IndexBuildError, IndexVerificationError
+from rulebasewatcher import RulebaseWatcher
+from screeningreport import ScreeningReport
+from resultsweeper import ResultSweeper
 import os
 import json
-from config import mongodb_link, secret_key, lab_values_collection
+from config import mongodb_link, secret_key, lab_values_collection, ensure_indexes_on_startup, watch_rulebase, rulebase_poll_interval, rulebase_settle_interval, \
+    sweep_results, result_sweep_interval
 
 
 # Configure logging
@@ -29,6 +34,19 @@ class Controller:
             self.db_manager = DatabaseManager(mongodb_link, 'ExpertSystem')
             self.rulebase_app = RulebaseApp(self.db_manager)
             self.lab_input_user_values_collection = self.db_manager.get_collection(lab_values_collection)
+            if ensure_indexes_on_startup:
+                try:
+                    IndexManager(self.db_manager).bootstrap()
+                except (IndexBuildError, IndexVerificationError) as e:
+                    app.logger.error(f"Index bootstrap failed, queries may be slow: {e}")
+            self.rulebase_watcher = None
+            if watch_rulebase:
+                self.rulebase_watcher = RulebaseWatcher(self.db_manager, rulebase_poll_interval, rulebase_settle_interval)
+                self.rulebase_watcher.start()
+            self.result_sweeper = None
+            if sweep_results:
+                self.result_sweeper = ResultSweeper(self.db_manager, result_sweep_interval)
+                self.result_sweeper.start()
         except Exception as e:
             app.logger.error(f"Error connecting to MongoDB: {e}")
             exit(1)
@@ -111,26 +129,76 @@ def delete_rule(disease_code):
         app.logger.error(f"Error deleting rule: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/rulebase_status', methods=['GET'])
+def rulebase_status():
+    """
+    Returns the state of this worker's compiled rulebase and the measured staleness of live updates.
+    """
+    sharded_evaluator = controller.db_manager.sharded_evaluator
+    sharding = sharded_evaluator.stats() if sharded_evaluator is not None else None
+    if controller.rulebase_watcher is None:
+        return jsonify({'status': 'success', 'mode': 'per_request', 'rulebase_version': controller.db_manager.get_rulebase_version(),
+                        'sharding': sharding})
+    return jsonify({'status': 'success', **controller.rulebase_watcher.stats(), 'sharding': sharding})
+
+@app.route('/explain_patient/<patient_id>', methods=['GET'])
+def explain_patient(patient_id):
+    """
+    Returns the matching diseases of a patient with the outcome of every condition and the
+    lab values that satisfied them.
+    """
+    try:
+        result = controller.db_manager.explain_patient(patient_id)
+        if result is None:
+            return jsonify({'status': 'error', 'message': f"Patient with ID {patient_id} not found."}), 404
+        return jsonify({'status': 'success', 'results': result.to_dict()})
+    except Exception as e:
+        app.logger.error(f"Error explaining patient data: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/screening_report', methods=['GET'])
+def screening_report():
+    """
+    Returns how many patients currently match each disease, by age band and gender.
+    - age_band: Width of the age bands in years (default 10).
+    - refresh: '1', 'true' or 'yes' recomputes the report even if a cached one exists.
+    """
+    try:
+        age_band = int(request.args.get('age_band', 10))
+    except ValueError:
+        age_band = 0
+    if age_band < 1:
+        return jsonify({'status': 'error', 'message': 'age_band must be a whole number of at least 1'}), 400
+    refresh = request.args.get('refresh', '').strip().lower() in ('1', 'true', 'yes')
+    try:
+        report = ScreeningReport(controller.db_manager, age_band).get_report(refresh=refresh)
+        return jsonify({'status': 'success', 'results': report})
+    except Exception as e:
+        app.logger.error(f"Error computing screening report: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/view_patient_data', methods=['GET', 'POST'])
 def view_patient_data():
     """
     Handles the view patient data page.
     - GET: Renders the view patient data page with all patient data.
-    - POST: Searches for a specific patient by ID and renders the page with the found patient data.
+    - POST: Searches for a specific patient by ID and renders the page with the found patient data
+      and the diseases matching their lab values.
     """
     try:
         if request.method == 'POST':
             patient_id = request.form.get('patient_id')
             if patient_id:
                 # Query MongoDB to find the patient by ID
-                found_patient = controller.lab_input_user_values_collection.find_one({'patient_id': patient_id})
+                found_patient = controller.db_manager.get_patient(patient_id)
                 if found_patient:
-                    return render_template('view_patient_data.html', patient_data=[found_patient])
+                    results = controller.db_manager.evaluate_patient(patient_id, found_patient)
+                    return render_template('view_patient_data.html', patient_data=[found_patient], results=results)
                 else:
                     return render_template('view_patient_data.html', patient_data=[], message=f"Patient with ID {patient_id} not found.")
         
         # Fetch all patient data from the User_Input_Lab_Values collection
-        patient_data = list(controller.lab_input_user_values_collection.find())
+        patient_data = controller.db_manager.get_all_patients()
         
         # Sort patient data by patient ID
         patient_data.sort(key=lambda x: x['patient_id'])
@@ -220,8 +288,10 @@ def update_rule(rule_id):
     result = controller.rulebase_app.update_rule(rule_id, rule.category, rule.disease_names, rule.disease_codes, rule.rules)
     if result['status'] == 'success':
         flash('Rule updated successfully', 'success')
+        for note in result['notes']:
+            flash(note, 'info')
     else:
-        flash('Failed to update rule', 'error')
+        flash(result['message'], 'error')
 
     return redirect(url_for('view_rulebase'))
 
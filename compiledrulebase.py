@@ -0,0 +1,409 @@
+import logging
+import datetime
+from thresholdindex import ThresholdIndex
+from unitnormalizer import UnitNormalizer, UNKNOWN_PARAMETER
+from evaluationresult import EvaluationResult, DiseaseMatch, EntryOutcome, ConditionOutcome
+from ruleaggregator import RuleAggregator
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Node kinds of the shared condition network
+NODE_FREE = 0
+NODE_INDEXED = 1
+NODE_GENERIC = 2
+
+# Gender ID of conditions that apply to every patient
+GENDER_ALL = 0
+
+class CompiledRulebase:
+    """
+    Evaluation-ready form of a list of RuleAggregator objects.
+
+    Identical conditions (same type, parameter, bounds, operator, unit, age
+    range and gender) are shared between all rule entries that use them, so
+    every distinct condition is evaluated at most once per patient. Diseases
+    match through the OR of their rule entries, each an AND over shared
+    conditions.
+
+    Range and comparison conditions are compiled into one ThresholdIndex per
+    parameter, so every lab value is looked up once instead of being checked
+    against each condition. Time-dependent conditions, which cannot be expressed
+    as an interval, are evaluated through their own evaluate method. Rules are
+    expected to have passed RuleValidator, so every range and comparison
+    condition has its bounds and age limits.
+
+    Parameter names and units are normalized once, when a condition is compiled
+    and when a patient's lab values enter evaluation: names resolve to integer
+    parameter IDs and thresholds and values are converted into the parameter's
+    canonical unit, so the indexes are keyed and compared without string work.
+
+    The per-condition data the evaluator reads (kind, age range, gender ID) is
+    kept in flat arrays indexed by node number, so the same evaluator also runs
+    directly on a memory-mapped snapshot (see rulebasesnapshot.py).
+
+    Single rules can be added, replaced or removed without recompiling the rest;
+    every such change increments revision.
+
+    Rules pruned by RuleValidator are evaluated in their pruned form but
+    described in their stored form (RuleAggregator.stored_rules): matching_rule
+    and explanations list every entry and condition the author stored.
+    """
+
+    def __init__(self, rules=(), normalizer=None):
+        """
+        Compiles the given rules.
+
+        :param rules: List of RuleAggregator objects.
+        :param normalizer: UnitNormalizer to use (defaults to the one built from mappings.json).
+        """
+        self.normalizer = normalizer or UnitNormalizer.default()
+        self.version = None
+        self.revision = 0
+        self._kind = []
+        self._age_min = []
+        self._age_max = []
+        self._gender = []
+        self._genders = {'all': GENDER_ALL}
+        self._generic = {}
+        self._indexes = {}
+        self._conditions = []
+        self._refs = []
+        self._free = []
+        self._signatures = {}
+        self._rules = {}
+
+        for rule in rules:
+            self.add_rule(rule)
+
+    def __len__(self):
+        return len(self._rules)
+
+    @property
+    def rules(self):
+        """
+        :return: List of the compiled RuleAggregator objects, in evaluation order.
+        """
+        return [rule for rule, _ in self._rules.values()]
+
+    @property
+    def condition_count(self):
+        """
+        :return: Number of distinct conditions in the network.
+        """
+        return len(self._signatures)
+
+    def thaw(self):
+        """
+        :return: A CompiledRulebase that supports incremental updates (this one).
+        """
+        return self
+
+    @staticmethod
+    def _rule_key(rule):
+        return str(rule._id) if rule._id is not None else id(rule)
+
+    def add_rule(self, rule):
+        """
+        Adds a rule to the network, replacing a compiled rule with the same _id.
+
+        :param rule: RuleAggregator object.
+        """
+        key = self._rule_key(rule)
+        entries = [(rule_entry, tuple(self._acquire(condition) for condition in rule_entry.conditions))
+                   for rule_entry in rule.rules]
+        previous = self._rules.get(key)
+        self._rules[key] = (rule, entries)
+        self.revision += 1
+        if previous is not None:
+            self._release_entries(previous[1])
+
+    def update_rule(self, rule):
+        """
+        Replaces a compiled rule. Conditions shared with the old version are kept.
+
+        :param rule: RuleAggregator object.
+        """
+        self.add_rule(rule)
+
+    def remove_rule(self, rule_id):
+        """
+        Removes a rule from the network.
+
+        :param rule_id: _id of the rule to remove.
+        :return: True if the rule was compiled, False otherwise.
+        """
+        previous = self._rules.pop(str(rule_id), None)
+        if previous is None:
+            return False
+        self.revision += 1
+        self._release_entries(previous[1])
+        return True
+
+    def _acquire(self, condition):
+        """
+        Returns the node of a condition, creating and indexing it if it is new.
+
+        :param condition: ConditionCompiler instance.
+        :return: Node number of the shared condition.
+        """
+        signature = condition.signature()
+        node = self._signatures.get(signature)
+        if node is not None:
+            self._refs[node] += 1
+            return node
+
+        interval = condition.interval()
+        indexed = interval is not None
+        if self._free:
+            node = self._free.pop()
+        else:
+            node = len(self._kind)
+            for column in (self._kind, self._age_min, self._age_max, self._gender, self._conditions, self._refs):
+                column.append(None)
+        self._kind[node] = NODE_INDEXED if indexed else NODE_GENERIC
+        self._age_min[node] = condition.age_min if indexed else 0
+        self._age_max[node] = condition.age_max if indexed else 0
+        self._gender[node] = self._genders.setdefault(condition.gender, len(self._genders))
+        self._conditions[node] = condition
+        self._refs[node] = 1
+        self._signatures[signature] = node
+
+        if not indexed:
+            self._generic[node] = condition
+            return node
+
+        parameter_id = self.normalizer.register_parameter(condition.parameter)
+        low, high, low_inclusive, high_inclusive = interval
+        if low != float('-inf'):
+            low = self.normalizer.convert(parameter_id, condition.unit, low)
+        if high != float('inf'):
+            high = self.normalizer.convert(parameter_id, condition.unit, high)
+        if parameter_id not in self._indexes:
+            self._indexes[parameter_id] = ThresholdIndex()
+        self._indexes[parameter_id].add(node, low, high, low_inclusive, high_inclusive)
+        return node
+
+    def _release_entries(self, entries):
+        """
+        Drops one reference from every node used by the entries and frees unused nodes.
+
+        :param entries: List of (RuleEntry, node tuple) pairs.
+        """
+        for _, nodes in entries:
+            for node in nodes:
+                self._refs[node] -= 1
+                if self._refs[node]:
+                    continue
+                condition = self._conditions[node]
+                del self._signatures[condition.signature()]
+                if self._kind[node] == NODE_INDEXED:
+                    parameter_id = self.normalizer.parameter_id(condition.parameter)
+                    self._indexes[parameter_id].remove(node)
+                    if not len(self._indexes[parameter_id]):
+                        del self._indexes[parameter_id]
+                else:
+                    del self._generic[node]
+                self._kind[node] = NODE_FREE
+                self._conditions[node] = None
+                self._free.append(node)
+
+    def normalize_lab_values(self, lab_values):
+        """
+        Builds the normalized view of a patient's currently valid lab values.
+
+        :param lab_values: List of lab values for the patient.
+        :return: List of (parameter ID, value in canonical unit, position in lab_values) tuples.
+        """
+        today = str(datetime.date.today())
+        normalized = []
+        for position, lab_value in enumerate(lab_values):
+            if lab_value['valid_until'] < today:
+                continue
+            parameter_id = self.normalizer.parameter_id(lab_value['parameter_name'])
+            if parameter_id == UNKNOWN_PARAMETER:
+                continue  # No compiled rule uses this parameter
+            value = self.normalizer.convert(parameter_id, lab_value.get('unit'), lab_value['value'])
+            normalized.append((parameter_id, value, position))
+        return normalized
+
+    def satisfied_conditions(self, lab_values, normalized=None):
+        """
+        Looks up every currently valid lab value in the threshold indexes.
+
+        :param lab_values: List of lab values for the patient.
+        :param normalized: Result of normalize_lab_values for lab_values, if already computed.
+        :return: Dictionary of indexed node -> position of the first lab value in its interval.
+        """
+        if normalized is None:
+            normalized = self.normalize_lab_values(lab_values)
+        satisfied = {}
+        for parameter_id, value, position in normalized:
+            index = self._indexes.get(parameter_id)
+            if index is not None:
+                for node in index.lookup(value):
+                    satisfied.setdefault(node, position)
+        return satisfied
+
+    def _diseases(self):
+        """
+        :return: Iterable of (disease, [(entry, node tuple), ...]) in evaluation order.
+        """
+        return self._rules.values()
+
+    def _describe(self, rule, rule_entry):
+        """
+        Builds the result dictionary of a matching rule entry.
+
+        :param rule: Disease as yielded by _diseases.
+        :param rule_entry: Entry as yielded by _diseases.
+        :return: Dictionary describing the matching disease, with the entry in its stored form.
+        """
+        return {
+            'disease_code': rule.disease_code,
+            'disease_name': rule.disease_name,
+            'category': rule.category,
+            'matching_rule': RuleAggregator.stored_entry(rule.stored_rules, rule_entry.to_dict())
+        }
+
+    def _entry_data(self, rule, rule_entry):
+        """
+        :param rule: Disease as yielded by _diseases.
+        :param rule_entry: Entry as yielded by _diseases.
+        :return: Tuple (dictionary of the evaluated entry, whose conditions are in node order,
+                 stored entry dictionaries of the disease or None if it was not pruned).
+        """
+        return rule_entry.to_dict(), rule.stored_rules
+
+    def _match(self, patient_age, patient_gender, lab_values, all_entries=False, normalized=None):
+        """
+        Runs the network for one patient.
+
+        :param patient_age: Age of the patient.
+        :param patient_gender: Gender of the patient.
+        :param lab_values: List of lab values for the patient.
+        :param all_entries: Whether to evaluate every entry of a matching disease instead
+                            of stopping at the first matching one.
+        :param normalized: Result of normalize_lab_values for lab_values, if already computed.
+        :return: Tuple (matches, satisfied, results): matches is a list of
+                 (disease, [(entry, nodes, met), ...]) for the matching diseases, satisfied
+                 is the result of satisfied_conditions and results maps every evaluated
+                 node to its outcome.
+        """
+        satisfied = self.satisfied_conditions(lab_values, normalized)
+        gender = self._genders.get(patient_gender, -1)
+        kind, age_min, age_max, genders = self._kind, self._age_min, self._age_max, self._gender
+        results = {}
+
+        def condition_met(node):
+            result = results.get(node)
+            if result is None:
+                if kind[node] == NODE_INDEXED:
+                    result = (node in satisfied and age_min[node] <= patient_age <= age_max[node]
+                              and (genders[node] == GENDER_ALL or genders[node] == gender))
+                else:
+                    result = self._generic[node].evaluate(patient_age, patient_gender, lab_values)
+                results[node] = result
+            return result
+
+        matches = []
+        for disease, entries in self._diseases():
+            if all_entries:
+                outcomes = [(entry, nodes, all(condition_met(node) for node in nodes)) for entry, nodes in entries]
+                if any(met for _, _, met in outcomes):
+                    matches.append((disease, outcomes))
+                continue
+            for entry, nodes in entries:
+                if all(condition_met(node) for node in nodes):
+                    matches.append((disease, [(entry, nodes, True)]))
+                    break  # Since rules are OR-ed, we can stop checking further rules for this disease
+        logging.debug(f"Evaluated {len(results)} of {self.condition_count} shared conditions")
+        return matches, satisfied, results
+
+    def match(self, patient_age, patient_gender, lab_values):
+        """
+        Evaluates the patient's lab values and returns the matching diseases undescribed.
+
+        :param patient_age: Age of the patient.
+        :param patient_gender: Gender of the patient.
+        :param lab_values: List of lab values for the patient.
+        :return: List of the matching RuleAggregator objects.
+        """
+        matches, _, _ = self._match(patient_age, patient_gender, lab_values)
+        return [disease for disease, _ in matches]
+
+    def evaluate(self, patient_age, patient_gender, lab_values, normalized=None):
+        """
+        Evaluates the patient's lab values against all compiled rules.
+
+        :param patient_age: Age of the patient.
+        :param patient_gender: Gender of the patient.
+        :param lab_values: List of lab values for the patient.
+        :param normalized: Result of normalize_lab_values for lab_values, if already computed.
+        :return: List of dictionaries describing the matching diseases.
+        """
+        matches, _, _ = self._match(patient_age, patient_gender, lab_values, normalized=normalized)
+        return [self._describe(disease, outcomes[0][0]) for disease, outcomes in matches]
+
+    def explain(self, patient_age, patient_gender, lab_values):
+        """
+        Evaluates the patient's lab values and explains every match in the same pass.
+        The explanation is assembled from the outcomes already computed by the
+        network, so only matching diseases add work.
+
+        :param patient_age: Age of the patient.
+        :param patient_gender: Gender of the patient.
+        :param lab_values: List of lab values for the patient.
+        :return: EvaluationResult instance.
+        """
+        matches, satisfied, results = self._match(patient_age, patient_gender, lab_values, all_entries=True)
+        disease_matches = []
+        for disease, outcomes in matches:
+            entries, stored_rules = [], None
+            for entry, nodes, met in outcomes:
+                entry_dict, stored_rules = self._entry_data(disease, entry)
+                conditions = []
+                for condition, node in zip(entry_dict['conditions'], nodes):
+                    position = satisfied.get(node) if results.get(node) else None
+                    conditions.append(ConditionOutcome(condition, results.get(node),
+                                                       lab_values[position] if position is not None else None))
+                entries.append(EntryOutcome(entry_dict['rule_id'], met, conditions))
+            if stored_rules is not None:
+                entries = self._stored_outcomes(stored_rules, entries)
+            description = self._describe(disease, next(entry for entry, _, met in outcomes if met))
+            disease_matches.append(DiseaseMatch(description['disease_code'], description['disease_name'],
+                                                description['category'], entries, description['matching_rule']))
+        return EvaluationResult(disease_matches, len(results), self.condition_count, self.version)
+
+    @staticmethod
+    def _stored_outcomes(stored_rules, entries):
+        """
+        Maps the outcomes of pruned entries back onto the stored entries. A pruned
+        condition is implied by the conditions kept in its entry, so it is met if the
+        entry is met and unknown (None) otherwise; a pruned entry was never evaluated.
+
+        :param stored_rules: Stored rule entry dictionaries of the disease.
+        :param entries: EntryOutcome objects of the evaluated entries.
+        :return: List of EntryOutcome objects, one per stored entry.
+        """
+        evaluated = {}
+        for entry in entries:
+            evaluated.setdefault(entry.rule_id, entry)
+        stored_outcomes = []
+        for stored in stored_rules:
+            entry = evaluated.pop(stored['rule_id'], None)
+            if entry is None:
+                stored_outcomes.append(EntryOutcome(stored['rule_id'], None,
+                                                    [ConditionOutcome(condition, None, None) for condition in stored['conditions']]))
+                continue
+            remaining = list(entry.conditions)
+            conditions = []
+            for condition in stored['conditions']:
+                outcome = next((outcome for outcome in remaining if outcome.condition == condition), None)
+                if outcome is None:
+                    conditions.append(ConditionOutcome(condition, True if entry.met else None, None))
+                else:
+                    remaining.remove(outcome)
+                    conditions.append(ConditionOutcome(condition, outcome.met, outcome.lab_value))
+            stored_outcomes.append(EntryOutcome(stored['rule_id'], entry.met, conditions))
+        return stored_outcomes
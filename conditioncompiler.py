@@ -23,6 +23,27 @@ class ConditionCompiler(ABC):
         """
         pass
 
+    def interval(self):
+        """
+        Describes the set of lab values satisfying the condition as a single interval.
+        
+        :return: Tuple (low, high, low_inclusive, high_inclusive), or None if the
+                 condition cannot be expressed as an interval.
+        """
+        return None
+
+    def signature(self):
+        """
+        Builds a hashable key identifying the condition. Conditions with equal
+        signatures always evaluate to the same result for the same patient.
+        
+        :return: Tuple of the condition's fields.
+        """
+        data = self.to_dict()
+        if self.parameter:
+            data['parameter'] = self.parameter.lower()
+        return tuple(sorted(data.items()))
+
     @staticmethod
     def from_dict(condition_data):
         """
@@ -105,6 +126,16 @@ class RangeCondition(ConditionCompiler):
         logging.debug(f"Condition not met for parameter {self.parameter}")
         return False
 
+    def interval(self):
+        """
+        Describes the range as a closed interval.
+        
+        :return: Tuple (min_value, max_value, True, True), or None if a bound is missing.
+        """
+        if self.min_value is None or self.max_value is None:
+            return None
+        return (self.min_value, self.max_value, True, True)
+
     def to_dict(self):
         """
         Converts the RangeCondition object to a dictionary.
@@ -182,6 +213,28 @@ class ComparisonCondition(ConditionCompiler):
             return value <= self.comparison_value
         return False
 
+    def interval(self):
+        """
+        Describes the comparison as an interval.
+        
+        :return: Tuple (low, high, low_inclusive, high_inclusive), or None if the
+                 operator is unknown or the comparison value is missing.
+        """
+        if self.comparison_value is None:
+            return None
+        inf = float('inf')
+        if self.operator == 'greater':
+            return (self.comparison_value, inf, False, False)
+        elif self.operator == 'less':
+            return (-inf, self.comparison_value, False, False)
+        elif self.operator == 'equal':
+            return (self.comparison_value, self.comparison_value, True, True)
+        elif self.operator == 'greater or equal':
+            return (self.comparison_value, inf, True, False)
+        elif self.operator == 'less or equal':
+            return (-inf, self.comparison_value, False, True)
+        return None
+
     def to_dict(self):
         """
         Converts the ComparisonCondition object to a dictionary.
@@ -2,3 +2,18 @@ secret_key = 'your_secret_key_here'
 mongodb_link='mongodb://172.16.105.132:27017/'
 lab_values_collection='User_Input_Lab_Values'
 rules_data_collection='Rulebase'
+rulebase_meta_collection='Rulebase_Meta'
+lab_readings_collection='Lab_Readings'
+screening_reports_collection='Screening_Reports'
+ensure_indexes_on_startup=True
+rulebase_snapshot_path='rulebase.snapshot'
+watch_rulebase=True
+rulebase_poll_interval=5
+rulebase_settle_interval=30  # seconds without rule changes before workers return to the shared snapshot
+lab_values_storage='embedded'  # 'embedded' or 'bucketed'
+lab_readings_bucket_size=200
+parallel_evaluation_workers=0  # shard processes for very large rulebases, 0 or 1 to evaluate in-process
+parallel_evaluation_min_rules=20000
+rule_max_age=150  # age_max given to conditions saved without one
+sweep_results=False  # run the result sweeper in this process; enable it in one process only, or run resultsweeper.py from cron
+result_sweep_interval=3600  # seconds between sweeps for expired patient results
@@ -1,19 +1,38 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 from flask import current_app, request
 from ruleaggregator import RuleAggregator, RuleEntry
 from conditioncompiler import ConditionCompiler
+from compiledrulebase import CompiledRulebase
+from rulebasesnapshot import load_snapshot, write_snapshot, SnapshotError
+from labreadingstore import LabReadingStore
+from labfileingestion import parse_date
+from shardedevaluator import ShardedEvaluator
+from rulevalidator import RuleValidator, RuleValidationError
+from evaluationresult import STALE_HORIZON
 import logging
+import threading
+import datetime
+import itertools
 from bson import ObjectId
 import config
-from config import lab_values_collection, rules_data_collection
+from config import lab_values_collection, rules_data_collection, rulebase_meta_collection, rulebase_snapshot_path, lab_values_storage, \
+    parallel_evaluation_workers, parallel_evaluation_min_rules
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class DatabaseManager:
     def __init__(self, uri, db_name):
+        # The shard processes are forked before the MongoClient starts its threads
+        self.sharded_evaluator = None
+        if parallel_evaluation_workers > 1:
+            self.sharded_evaluator = ShardedEvaluator(parallel_evaluation_workers, parallel_evaluation_min_rules)
         self.client = MongoClient(uri)
         self.db = self.client[db_name]
+        self.compiled_rulebase = None
+        self.rulebase_lock = threading.RLock()
+        self.rulebase_watcher = None
+        self.lab_reading_store = LabReadingStore(self) if lab_values_storage == 'bucketed' else None
 
     def get_collection(self, collection_name):
         logging.debug(f"Getting collection: {collection_name}")
@@ -91,7 +110,21 @@ class DatabaseManager:
 
                 rules_data.append(disease_entry)
 
+            # Validate every disease before saving any of them
+            # Rules are stored unpruned; pruning happens when they are compiled
+            validator = RuleValidator()
+            validated, all_notes = [], []
             for rule_data in rules_data:
+                try:
+                    rule_data, notes = validator.validate_rule(rule_data, prune=False)
+                except RuleValidationError as e:
+                    return {'status': 'error', 'message': f"Invalid rule for {rule_data['disease_code']}: {e}"}
+                for note in notes:
+                    logging.info(f"Rule for {rule_data['disease_code']}: {note}")
+                    all_notes.append(f"{rule_data['disease_code']}: {note}")
+                validated.append(rule_data)
+
+            for rule_data in validated:
                 rule = RuleAggregator(
                     rule_data['category'],
                     rule_data['disease_name'],
@@ -101,7 +134,7 @@ class DatabaseManager:
                 )
                 self.save_rule(rule)
 
-            return {'status': 'success', 'message': 'Rulebase data saved successfully'}
+            return {'status': 'success', 'message': 'Rulebase data saved successfully', 'notes': all_notes}
 
         except Exception as e:
             logging.error(f'Error adding data: {str(e)}')
@@ -137,15 +170,15 @@ class DatabaseManager:
             valid_untils = request.form.getlist('valid-until')
             times = request.form.getlist('time-lab-value')
 
-            # Prepare lab values data
+            # Prepare lab values data; everything is validated before anything is written
             lab_values_data = []
             for i in range(len(parameters)):
                 lab_value_data = {
                     'parameter_name': parameters[i],
                     'value': float(values[i]),
                     'unit': units[i],
-                    'valid_until': valid_untils[i],
-                    'time': times[i]
+                    'valid_until': parse_date(valid_untils[i], 'valid-until'),
+                    'time': parse_date(times[i], 'time-lab-value')
                 }
                 lab_values_data.append(lab_value_data)
 
@@ -153,24 +186,43 @@ class DatabaseManager:
             collection = self.get_collection(lab_values_collection)  # Specify the correct collection name
             logging.debug(f"Collection: {collection}")
 
-            # Check if the patient already exists
+            # Check if the patient already exists; the stored results are marked stale either way and
+            # lab_values_revision is bumped, so a concurrent refresh_patient_results does not overwrite that
             existing_patient = collection.find_one({'patient_id': patient_id})
-            if existing_patient:
+            if self.lab_reading_store is not None:
+                # Readings first: a patient document with the new revision always has its readings stored
+                self.lab_reading_store.append(patient_id, lab_values_data)
+                if existing_patient:
+                    collection.update_one({'patient_id': patient_id}, {'$set': {'results_valid_until': STALE_HORIZON},
+                                                                       '$inc': {'lab_values_revision': 1}})
+                else:
+                    collection.insert_one({'patient_id': patient_id, 'age': age, 'gender': gender,
+                                           'results_valid_until': STALE_HORIZON, 'lab_values_revision': 1})
+            elif existing_patient:
                 collection.update_one(
                     {'patient_id': patient_id},
-                    {'$push': {'lab_values': {'$each': lab_values_data}}}
+                    {'$push': {'lab_values': {'$each': lab_values_data}},
+                     '$set': {'results_valid_until': STALE_HORIZON},
+                     '$inc': {'lab_values_revision': 1}}
                 )
             else:
                 new_patient_data = {
                     'patient_id': patient_id,
                     'age': age,
                     'gender': gender,
-                    'lab_values': lab_values_data
+                    'lab_values': lab_values_data,
+                    'results_valid_until': STALE_HORIZON,
+                    'lab_values_revision': 1
                 }
                 collection.insert_one(new_patient_data)
 
-            # Evaluate lab values
-            matching_diseases = self.evaluate_lab_values(age, gender, lab_values_data)
+            # Evaluate lab values; they are saved already, so a failure must not be reported as a failed save
+            try:
+                matching_diseases = self.evaluate_lab_values(age, gender, lab_values_data)
+            except Exception as e:
+                current_app.logger.error(f"Error occurred while evaluating the saved lab values of patient {patient_id}: {e}")
+                return {'status': 'success', 'message': f'Lab values saved successfully, but evaluating them failed: {e}',
+                        'results': [], 'evaluated': False}
             logging.debug(f"Matching diseases: {matching_diseases}")
 
             # Return the result
@@ -183,42 +235,242 @@ class DatabaseManager:
             current_app.logger.error(f"Error occurred while saving lab values: {e}")
             return {'status': 'error', 'message': str(e)}
 
+    def get_patient(self, patient_id):
+        """
+        Returns a patient document with its lab values, from whichever storage holds them.
+        
+        :param patient_id: ID of the patient.
+        :return: Patient dictionary with 'lab_values', or None if not found.
+        """
+        patient = self.get_collection(lab_values_collection).find_one({'patient_id': patient_id})
+        if patient and self.lab_reading_store is not None:
+            patient['lab_values'] = patient.get('lab_values', []) + self.lab_reading_store.get_lab_values(patient_id)
+        return patient
+
+    def get_all_patients(self):
+        """
+        Returns all patient documents with their lab values.
+        
+        :return: List of patient dictionaries with 'lab_values'.
+        """
+        patients = list(self.get_collection(lab_values_collection).find())
+        if self.lab_reading_store is not None:
+            lab_values = self.lab_reading_store.get_all_lab_values()
+            for patient in patients:
+                patient['lab_values'] = patient.get('lab_values', []) + lab_values.get(patient['patient_id'], [])
+        return patients
+
+    def iter_patients(self):
+        """
+        Streams all patient documents with their lab values, one at a time.
+        
+        Patients are read over a cursor sorted by patient_id; in bucketed storage the
+        buckets are read over a second cursor in the same order and merged in, so
+        only one patient's readings are held in memory at a time.
+        
+        :return: Iterator of patient dictionaries with 'lab_values'.
+        """
+        patients = self.get_collection(lab_values_collection).find().sort('patient_id', 1)
+        if self.lab_reading_store is None:
+            yield from patients
+            return
+
+        readings = itertools.groupby(self.lab_reading_store.find_buckets({}), key=lambda reading: reading[0])
+        patient_id, lab_values = next(readings, (None, ()))
+        for patient in patients:
+            while patient_id is not None and patient_id < patient['patient_id']:
+                patient_id, lab_values = next(readings, (None, ()))
+            patient['lab_values'] = patient.get('lab_values', [])
+            if patient_id == patient['patient_id']:
+                patient['lab_values'] += [lab_value for _, lab_value in lab_values]
+            yield patient
+
+    def get_lab_value_history(self, patient_id, parameter_name, start=None, end=None):
+        """
+        Returns a patient's readings of one parameter, optionally within a time range.
+        
+        :param patient_id: ID of the patient.
+        :param parameter_name: Parameter to return.
+        :param start: Earliest reading time ('YYYY-MM-DD'), or None.
+        :param end: Latest reading time ('YYYY-MM-DD'), or None.
+        :return: List of lab value dictionaries.
+        """
+        if self.lab_reading_store is not None:
+            return self.lab_reading_store.get_lab_values(patient_id, parameter_name, start, end)
+        patient = self.get_patient(patient_id) or {}
+        return [lab_value for lab_value in patient.get('lab_values', [])
+                if lab_value['parameter_name'] == parameter_name
+                and (start is None or lab_value['time'] >= start) and (end is None or lab_value['time'] <= end)]
+
+    def evaluate_patient(self, patient_id, patient=None):
+        """
+        Returns the matching diseases of all stored lab values of a patient. The stored
+        result is returned as long as it was computed with the current rulebase version
+        and its valid_until horizon has not passed; otherwise the patient is re-evaluated.
+        
+        :param patient_id: ID of the patient.
+        :param patient: Patient dictionary as returned by get_patient, if already read (optional).
+        :return: List of dictionaries describing the matching diseases.
+        """
+        patient = patient or self.get_patient(patient_id)
+        if not patient:
+            return []
+        horizon = patient.get('results_valid_until')
+        if ('results' in patient and patient.get('results_rulebase_version') == self.get_rulebase_version()
+                and (horizon is None or horizon >= str(datetime.date.today()))):
+            return patient['results']
+        return self.refresh_patient_results(patient).matching_diseases
+
+    def refresh_patient_results(self, patient):
+        """
+        Evaluates all stored lab values of a patient and stores the matches on the patient
+        document with their valid_until horizon (see EvaluationResult.valid_until) and the
+        version of the rulebase that produced them.
+        
+        The matches are only stored if no lab values were added since the patient was read
+        (its lab_values_revision is unchanged); otherwise the newer, stale mark is kept and
+        the patient is re-evaluated on its next read or sweep.
+        
+        :param patient: Patient dictionary as returned by get_patient.
+        :return: EvaluationResult instance.
+        """
+        result = self.explain_lab_values(patient['age'], patient['gender'], patient['lab_values'])
+        stored = self.get_collection(lab_values_collection).update_one(
+            {'patient_id': patient['patient_id'], 'lab_values_revision': patient.get('lab_values_revision')},
+            {'$set': {
+                'results': result.matching_diseases,
+                'results_valid_until': result.valid_until,
+                'results_rulebase_version': result.rulebase_version,
+                'results_evaluated_at': str(datetime.date.today())
+            }}
+        )
+        if not stored.matched_count:
+            logging.debug(f"Lab values of patient {patient['patient_id']} changed during evaluation, results not stored")
+        return result
+
     def save_rule(self, rule):
         collection = self.get_collection(rules_data_collection)  # Specify the correct collection name
         collection.insert_one(rule.to_dict())
+        self.bump_rulebase_version()
+
+    def get_rulebase_version_document(self):
+        """
+        Returns the version document of the Rulebase collection.
+        
+        :return: Dictionary with 'version' and, once the rulebase has been changed, 'updated_at'.
+        """
+        document = self.get_collection(rulebase_meta_collection).find_one({'_id': 'rulebase_version'})
+        return document or {'_id': 'rulebase_version', 'version': 0}
+
+    def get_rulebase_version(self):
+        """
+        Returns the version counter of the Rulebase collection.
+        
+        :return: Integer version, 0 if the rulebase has never been changed.
+        """
+        return self.get_rulebase_version_document()['version']
+
+    def bump_rulebase_version(self):
+        """
+        Increments the version counter of the Rulebase collection. Must be called after every write to it.
+        
+        :return: The new version.
+        """
+        document = self.get_collection(rulebase_meta_collection).find_one_and_update(
+            {'_id': 'rulebase_version'},
+            {'$inc': {'version': 1}, '$currentDate': {'updated_at': True}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return document['version']
+
+    def get_compiled_rulebase(self):
+        """
+        Returns the compiled rulebase for the current rulebase version. The snapshot file is
+        reused if it matches the version; otherwise the rules are compiled from MongoDB and
+        a new snapshot is written for the other workers.
+        
+        :return: CompiledRulebase instance.
+        """
+        version = self.get_rulebase_version()
+        if self.compiled_rulebase is not None and self.compiled_rulebase.version == version:
+            return self.compiled_rulebase
 
-    def evaluate_lab_values(self, patient_age, patient_gender, lab_values):
         try:
-            rules = self.get_all_rules()
-            logging.debug(f"Fetched {len(rules)} rules for evaluation")
-
-            matching_diseases = []
-
-            for rule in rules:
-                logging.debug(f"Evaluating rule for disease: {rule.disease_name}")
-                for rule_entry in rule.rules:
-                    rule_conditions_met = True
-                    for condition in rule_entry.conditions:
-                        if not condition.evaluate(patient_age, patient_gender, lab_values):
-                            logging.debug(f"Condition not met: {condition}")
-                            rule_conditions_met = False
-                            break
-                    if rule_conditions_met:
-                        logging.debug(f"All conditions met for rule entry: {rule_entry}")
-                        matching_diseases.append({
-                            'disease_code': rule.disease_code,
-                            'disease_name': rule.disease_name,
-                            'category': rule.category,
-                            'matching_rule': rule_entry.to_dict()
-                        })
-                        break  # Since rules are OR-ed, we can stop checking further rules for this disease
-
-            logging.debug(f"Found {len(matching_diseases)} matching diseases")
-            return matching_diseases
-        except Exception as e:
-            logging.error(f"Error occurred while evaluating lab values: {e}")
-            return []
+            rulebase = load_snapshot(rulebase_snapshot_path, version)
+        except SnapshotError as e:
+            logging.warning(f"Ignoring unreadable rulebase snapshot, recompiling: {e}")
+            rulebase = None
+        if rulebase is None:
+            rulebase = CompiledRulebase(self.get_all_rules())
+            rulebase.version = version
+            try:
+                write_snapshot(rulebase, rulebase_snapshot_path, version)
+                rulebase = load_snapshot(rulebase_snapshot_path, version) or rulebase
+            except (OSError, SnapshotError) as e:
+                logging.warning(f"Could not write rulebase snapshot: {e}")
+        self.compiled_rulebase = rulebase
+        return rulebase
+
+    def get_active_rulebase(self):
+        """
+        Returns the compiled rulebase to evaluate against. While the rulebase watcher runs
+        its rulebase is used as is; otherwise the rulebase version is checked first.
+        Must be called while holding rulebase_lock.
+        
+        :return: CompiledRulebase instance.
+        """
+        rulebase = self.compiled_rulebase
+        if rulebase is None or self.rulebase_watcher is None or not self.rulebase_watcher.is_alive():
+            rulebase = self.get_compiled_rulebase()
+        return rulebase
+
+    def evaluate_lab_values(self, patient_age, patient_gender, lab_values):
+        with self.rulebase_lock:
+            rulebase = self.get_active_rulebase()
+            logging.debug(f"Using {len(rulebase)} rules of rulebase version {rulebase.version} for evaluation")
+
+            if self.sharded_evaluator is not None:
+                matching_diseases = self.sharded_evaluator.evaluate(rulebase, patient_age, patient_gender, lab_values)
+            else:
+                matching_diseases = rulebase.evaluate(patient_age, patient_gender, lab_values)
+
+        logging.debug(f"Found {len(matching_diseases)} matching diseases")
+        return matching_diseases
+
+    def explain_lab_values(self, patient_age, patient_gender, lab_values):
+        """
+        Evaluates lab values and returns the matches with per-condition outcomes.
+        
+        :param patient_age: Age of the patient.
+        :param patient_gender: Gender of the patient.
+        :param lab_values: List of lab values for the patient.
+        :return: EvaluationResult instance.
+        """
+        with self.rulebase_lock:
+            return self.get_active_rulebase().explain(patient_age, patient_gender, lab_values)
+
+    def explain_patient(self, patient_id):
+        """
+        Evaluates all stored lab values of a patient and explains the matches.
+        
+        :param patient_id: ID of the patient.
+        :return: EvaluationResult instance, or None if the patient is not found.
+        """
+        patient = self.get_patient(patient_id)
+        if not patient:
+            return None
+        return self.explain_lab_values(patient['age'], patient['gender'], patient['lab_values'])
 
     def get_all_rules(self):
         collection = self.get_collection(rules_data_collection)  # Specify the correct collection name
-        return [RuleAggregator.from_dict(rule) for rule in collection.find()]
\ No newline at end of file
+        validator = RuleValidator()
+        rules = []
+        for document in collection.find():
+            try:
+                rule_data, _ = validator.validate_rule(document)
+            except RuleValidationError as e:
+                logging.error(f"Skipping invalid rule {document['_id']} ({document.get('disease_code')}): {e}")
+                continue
+            rules.append(RuleAggregator.from_dict(rule_data))
+        return rules
\ No newline at end of file
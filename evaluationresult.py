@@ -0,0 +1,174 @@
+# valid_until horizon marking a stored result as stale; sorts before every date
+STALE_HORIZON = ''
+
+
+class ConditionOutcome:
+    """
+    Outcome of one condition of a rule entry for one patient.
+    """
+
+    def __init__(self, condition, met, lab_value):
+        """
+        Initializes the ConditionOutcome with the given parameters.
+
+        :param condition: Dictionary representation of the condition.
+        :param met: True or False, or None if evaluation stopped before reaching the condition
+                    or the condition was pruned (see RuleValidator) and nothing implies it.
+        :param lab_value: The first lab value satisfying the condition, or None if the
+                          condition is not met or was decided by its own evaluate method.
+        """
+        self.condition = condition
+        self.met = met
+        self.lab_value = lab_value
+
+    def to_dict(self):
+        """
+        Convert the ConditionOutcome instance to a dictionary.
+
+        :return: Dictionary representation of the instance.
+        """
+        return {
+            'condition': self.condition,
+            'met': self.met,
+            'lab_value': self.lab_value
+        }
+
+
+class EntryOutcome:
+    """
+    Outcome of one rule entry (an AND of conditions) of a matching disease.
+    """
+
+    def __init__(self, rule_id, met, conditions):
+        """
+        Initializes the EntryOutcome with the given parameters.
+
+        :param rule_id: ID of the rule entry.
+        :param met: Whether all conditions of the entry are met, or None if the entry was
+                    pruned (see RuleValidator) and never evaluated.
+        :param conditions: List of ConditionOutcome objects, in the order of the entry.
+        """
+        self.rule_id = rule_id
+        self.met = met
+        self.conditions = conditions
+
+    def to_dict(self):
+        """
+        Convert the EntryOutcome instance to a dictionary.
+
+        :return: Dictionary representation of the instance.
+        """
+        return {
+            'rule_id': self.rule_id,
+            'met': self.met,
+            'conditions': [condition.to_dict() for condition in self.conditions]
+        }
+
+
+class DiseaseMatch:
+    """
+    A disease matched by at least one of its rule entries, with the outcome of every entry.
+    """
+
+    def __init__(self, disease_code, disease_name, category, entries, matching_rule):
+        """
+        Initializes the DiseaseMatch with the given parameters.
+
+        :param disease_code: Code of the disease.
+        :param disease_name: Name of the disease.
+        :param category: Category of the disease.
+        :param entries: List of EntryOutcome objects, one per rule entry of the disease.
+        :param matching_rule: Dictionary representation of the first matching rule entry.
+        """
+        self.disease_code = disease_code
+        self.disease_name = disease_name
+        self.category = category
+        self.entries = entries
+        self.matching_rule = matching_rule
+
+    @property
+    def valid_until(self):
+        """
+        :return: Earliest valid_until among the lab values supporting the reported matching
+                 rule entry, or None if none of them expire (time-dependent conditions).
+        """
+        entry = next((entry for entry in self.entries if entry.met), None)
+        if entry is None:
+            return None
+        dates = [condition.lab_value['valid_until'] for condition in entry.conditions if condition.lab_value is not None]
+        return min(dates) if dates else None
+
+    def to_dict(self):
+        """
+        Convert the DiseaseMatch instance to a dictionary.
+
+        :return: Dictionary representation of the instance.
+        """
+        return {
+            'disease_code': self.disease_code,
+            'disease_name': self.disease_name,
+            'category': self.category,
+            'matching_rule': self.matching_rule,
+            'entries': [entry.to_dict() for entry in self.entries]
+        }
+
+
+class EvaluationResult:
+    """
+    Result of evaluating one patient against the whole rulebase in a single pass:
+    the matching diseases with per-condition outcomes and the lab values that
+    satisfied them. Only matching diseases are described, so the size of the
+    result grows with the number of matches, not with the size of the rulebase.
+    """
+
+    def __init__(self, matches, conditions_evaluated, conditions_total, rulebase_version=None):
+        """
+        Initializes the EvaluationResult with the given parameters.
+
+        :param matches: List of DiseaseMatch objects.
+        :param conditions_evaluated: Number of distinct conditions evaluated for the patient.
+        :param conditions_total: Number of distinct conditions in the rulebase.
+        :param rulebase_version: Version of the rulebase the patient was evaluated against.
+        """
+        self.matches = matches
+        self.conditions_evaluated = conditions_evaluated
+        self.conditions_total = conditions_total
+        self.rulebase_version = rulebase_version
+
+    @property
+    def matching_diseases(self):
+        """
+        :return: The matches in the format returned by CompiledRulebase.evaluate.
+        """
+        return [{
+            'disease_code': match.disease_code,
+            'disease_name': match.disease_name,
+            'category': match.category,
+            'matching_rule': match.matching_rule
+        } for match in self.matches]
+
+    @property
+    def valid_until(self):
+        """
+        Lab values only drop out of evaluation as they expire, so the matches stay
+        exactly the same until a lab value supporting one of them expires.
+
+        :return: Last day ('YYYY-MM-DD') on which the result is certainly still correct,
+                 or None if it does not expire.
+        """
+        dates = [match.valid_until for match in self.matches if match.valid_until is not None]
+        return min(dates) if dates else None
+
+    def to_dict(self):
+        """
+        Convert the EvaluationResult instance to a dictionary.
+
+        :return: Dictionary representation of the instance.
+        """
+        return {
+            'rulebase_version': self.rulebase_version,
+            'valid_until': self.valid_until,
+            'conditions_evaluated': self.conditions_evaluated,
+            'conditions_total': self.conditions_total,
+            'matches': [match.to_dict() for match in self.matches]
+        }
@@ -0,0 +1,188 @@
+import argparse
+import logging
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+import config
+from config import lab_values_collection, rules_data_collection, rulebase_meta_collection, lab_readings_collection, \
+    screening_reports_collection
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class IndexBuildError(RuntimeError):
+    """
+    Raised when one or more indexes cannot be created.
+    """
+
+
+class IndexVerificationError(RuntimeError):
+    """
+    Raised when a query used by the application is not covered by an index.
+    """
+
+
+class IndexManager:
+    """
+    Creates the indexes needed by the application and verifies that every
+    filtered query issued by the application is answered by one of them.
+    """
+
+    # Index specifications per collection: (keys, options)
+    INDEXES = {
+        lab_values_collection: [
+            ([('patient_id', ASCENDING)], {'name': 'patient_id_unique', 'unique': True}),
+            ([('lab_values.parameter_name', ASCENDING)], {'name': 'lab_values_parameter_name'}),
+            ([('lab_values.parameter_name', ASCENDING), ('lab_values.valid_until', ASCENDING)],
+             {'name': 'lab_values_parameter_name_valid_until'}),
+            ([('gender', ASCENDING), ('age', ASCENDING)], {'name': 'gender_age'}),
+            ([('results_valid_until', ASCENDING)], {'name': 'results_valid_until'}),
+        ],
+        rules_data_collection: [
+            ([('disease_code', ASCENDING)], {'name': 'disease_code'}),
+            ([('category', ASCENDING), ('disease_code', ASCENDING)], {'name': 'category_disease_code'}),
+            ([('rules.conditions.parameter', ASCENDING)], {'name': 'rules_conditions_parameter'}),
+        ],
+        lab_readings_collection: [
+            ([('patient_id', ASCENDING), ('parameter_name', ASCENDING), ('window', ASCENDING), ('count', ASCENDING)],
+             {'name': 'patient_id_parameter_name_window_count'}),
+        ],
+    }
+
+    # Every filtered query issued by app.py, databasemanager.py and rulebaseapp.py:
+    # (collection, sample filter, where it is used). Unfiltered find() calls are
+    # deliberate full reads and are not listed here.
+    QUERIES = [
+        (lab_values_collection, {'patient_id': ''}, 'DatabaseManager.save_lab_values, view_patient_data'),
+        (rules_data_collection, {'disease_code': ''}, 'RulebaseApp.delete_rule'),
+        (rules_data_collection, {'_id': ObjectId()}, 'RulebaseApp.get_rule_by_id, RulebaseApp.update_rule'),
+        (lab_values_collection, {'results_valid_until': {'$lt': ''}}, 'ResultSweeper.sweep'),
+        (rulebase_meta_collection, {'_id': 'rulebase_version'}, 'DatabaseManager.get_rulebase_version'),
+        (lab_readings_collection, {'patient_id': '', 'parameter_name': '', 'window': '', 'count': {'$lt': 1}},
+         'LabReadingStore.append'),
+        (lab_readings_collection, {'patient_id': '', 'parameter_name': ''}, 'LabReadingStore.get_lab_values'),
+        (screening_reports_collection, {'_id': ''}, 'ScreeningReport.get_report'),
+    ]
+
+    def __init__(self, db):
+        """
+        Initializes the IndexManager with the given database.
+
+        :param db: DatabaseManager instance.
+        """
+        self.db = db
+
+    def ensure_indexes(self):
+        """
+        Creates all indexes listed in INDEXES. Existing indexes are left untouched.
+        An index that cannot be built does not stop the others from being created.
+
+        :raises IndexBuildError: If any index could not be created.
+        """
+        failures = []
+        for collection_name, indexes in self.INDEXES.items():
+            collection = self.db.get_collection(collection_name)
+            for keys, options in indexes:
+                try:
+                    name = collection.create_index(keys, **options)
+                except OperationFailure as e:
+                    reason = (e.details or {}).get('errmsg', str(e))
+                    if e.code == 11000:
+                        reason += ' (find the duplicates with: python indexmanager.py --find-duplicates)'
+                    failures.append(f"{options['name']} on {collection_name}: {reason}")
+                    continue
+                logging.debug(f"Ensured index {name} on {collection_name}")
+
+        if failures:
+            raise IndexBuildError(f"Indexes could not be created: {'; '.join(failures)}")
+
+    def find_duplicates(self):
+        """
+        Finds the documents that prevent the unique indexes in INDEXES from being built.
+
+        :return: List of (collection name, index name, duplicated key values, number of documents).
+        """
+        duplicates = []
+        for collection_name, indexes in self.INDEXES.items():
+            collection = self.db.get_collection(collection_name)
+            for keys, options in indexes:
+                if not options.get('unique'):
+                    continue
+                group_id = {field.replace('.', '_'): f'${field}' for field, _ in keys}
+                pipeline = [
+                    {'$group': {'_id': group_id, 'count': {'$sum': 1}}},
+                    {'$match': {'count': {'$gt': 1}}}
+                ]
+                for row in collection.aggregate(pipeline, allowDiskUse=True):
+                    duplicates.append((collection_name, options['name'], row['_id'], row['count']))
+        return duplicates
+
+    def verify_query_plans(self):
+        """
+        Runs explain() on every query listed in QUERIES.
+
+        :raises IndexVerificationError: If any query plan contains a collection scan.
+        """
+        uncovered = []
+        for collection_name, query, used_in in self.QUERIES:
+            collection = self.db.get_collection(collection_name)
+            plan = collection.find(query).explain()
+            winning_plan = plan.get('queryPlanner', {}).get('winningPlan', {})
+            stages = self._plan_stages(winning_plan)
+            logging.debug(f"Query {query} on {collection_name} uses stages {stages}")
+            if 'COLLSCAN' in stages:
+                uncovered.append(f"{collection_name} {list(query)} ({used_in})")
+
+        if uncovered:
+            raise IndexVerificationError(f"Queries not covered by an index: {'; '.join(uncovered)}")
+
+    def bootstrap(self, verify=True):
+        """
+        Ensures the indexes and optionally verifies the query plans.
+
+        :param verify: Whether to run verify_query_plans after creating the indexes.
+        """
+        self.ensure_indexes()
+        if verify:
+            self.verify_query_plans()
+
+    @staticmethod
+    def _plan_stages(plan):
+        """
+        Collects the stage names of a (possibly nested) explain() plan.
+
+        :param plan: Plan dictionary from explain().
+        :return: List of stage names.
+        """
+        stages = []
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for key in ('inputStage', 'queryPlan'):
+            if key in plan:
+                stages.extend(IndexManager._plan_stages(plan[key]))
+        for child in plan.get('inputStages', []):
+            stages.extend(IndexManager._plan_stages(child))
+        return stages
+
+
+if __name__ == '__main__':
+    from databasemanager import DatabaseManager
+
+    parser = argparse.ArgumentParser(description='Create and verify the MongoDB indexes of the expert system.')
+    parser.add_argument('--verify-only', action='store_true', help='Only verify the query plans, do not create indexes.')
+    parser.add_argument('--find-duplicates', action='store_true',
+                        help='List the documents that prevent the unique indexes from being built.')
+    args = parser.parse_args()
+
+    index_manager = IndexManager(DatabaseManager(config.mongodb_link, 'ExpertSystem'))
+    if args.find_duplicates:
+        duplicates = index_manager.find_duplicates()
+        for collection_name, index_name, values, count in duplicates:
+            logging.info(f"{collection_name} {index_name}: {count} documents with {values}")
+        logging.info(f"Found {len(duplicates)} duplicated keys")
+        raise SystemExit(1 if duplicates else 0)
+    if not args.verify_only:
+        index_manager.ensure_indexes()
+    index_manager.verify_query_plans()
+    logging.info('All queries are covered by an index')
@@ -0,0 +1,308 @@
+import argparse
+import csv
+import datetime
+import json
+import logging
+import time
+from pymongo import UpdateOne
+import config
+from config import lab_values_collection
+from evaluationresult import STALE_HORIZON
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def read_csv_rows(lab_file):
+    """
+    Reads a CSV lab extract row by row. The header line must name the columns
+    patient_id, age, gender, parameter_name, value, unit, valid_until and time.
+
+    :param lab_file: Open text file.
+    :return: Iterator of row dictionaries.
+    """
+    yield from csv.DictReader(lab_file)
+
+
+def read_pipe_rows(lab_file):
+    """
+    Reads an HL7-like pipe-delimited lab extract. A 'PID|patient_id|age|gender'
+    segment opens a patient and every following
+    'OBX|parameter_name|value|unit|valid_until|time' segment is one of its lab
+    values. Other segments are ignored.
+
+    :param lab_file: Open text file.
+    :return: Iterator of row dictionaries with the same keys as read_csv_rows.
+    """
+    patient = {}
+    for line in lab_file:
+        fields = line.rstrip('\r\n').split('|')
+        if fields[0] == 'PID':
+            patient = dict(zip(['patient_id', 'age', 'gender'], fields[1:4]))
+        elif fields[0] == 'OBX':
+            row = dict(zip(['parameter_name', 'value', 'unit', 'valid_until', 'time'], fields[1:6]))
+            row.update(patient)
+            yield row
+
+
+READERS = {
+    'csv': read_csv_rows,
+    'hl7': read_pipe_rows,
+}
+
+# Gender spellings found in lab extracts, mapped to the genders of the rules; any other
+# gender is stored as 'other', which only rules for all genders match
+GENDERS = {
+    'm': 'male',
+    'male': 'male',
+    'f': 'female',
+    'female': 'female',
+}
+OTHER_GENDER = 'other'
+
+
+def parse_date(value, field):
+    """
+    Parses an ISO 8601 date, as lab value dates are compared as 'YYYY-MM-DD' strings.
+
+    :param value: Date string.
+    :param field: Name of the field, for the error message.
+    :return: The date as 'YYYY-MM-DD'.
+    :raises ValueError: If the value is not an ISO 8601 date.
+    """
+    try:
+        return datetime.date.fromisoformat(value.strip()).isoformat()
+    except ValueError:
+        raise ValueError(f"{field} {value!r} is not an ISO 8601 date")
+
+
+def parse_row(row):
+    """
+    Validates a row and converts its fields the way save_lab_values does.
+
+    :param row: Row dictionary.
+    :return: Tuple (patient_id, age, gender, lab value dictionary).
+    :raises ValueError: If a field is missing or cannot be converted.
+    """
+    patient_id = row.get('patient_id')
+    if not patient_id:
+        raise ValueError("patient_id is missing")
+    gender = row.get('gender')
+    if not gender:
+        raise ValueError("gender is missing")
+    for field in ('parameter_name', 'age', 'value', 'valid_until', 'time'):
+        if not row.get(field):
+            raise ValueError(f"{field} is missing")
+
+    lab_value = {
+        'parameter_name': row['parameter_name'],
+        'value': float(row['value']),
+        'unit': row.get('unit'),
+        'valid_until': parse_date(row['valid_until'], 'valid_until'),
+        'time': parse_date(row['time'], 'time')
+    }
+    return patient_id, int(row['age']), GENDERS.get(gender.strip().lower(), OTHER_GENDER), lab_value
+
+
+class IngestionReport:
+    """
+    Progress and throughput of a lab file ingestion.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty IngestionReport and starts its clock.
+        """
+        self.rows_read = 0
+        self.rows_invalid = 0
+        self.rows_written = 0
+        self.patients_written = 0
+        self.patients_failed = 0
+        self.batches = 0
+        self.matches = 0
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rows_per_second(self):
+        return self.rows_read / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        """
+        Convert the IngestionReport instance to a dictionary.
+
+        :return: Dictionary representation of the instance.
+        """
+        return {
+            'rows_read': self.rows_read,
+            'rows_invalid': self.rows_invalid,
+            'rows_written': self.rows_written,
+            'patients_written': self.patients_written,
+            'patients_failed': self.patients_failed,
+            'batches': self.batches,
+            'matches': self.matches,
+            'elapsed': round(self.elapsed, 3),
+            'rows_per_second': round(self.rows_per_second, 1)
+        }
+
+
+class LabFileIngestion:
+    """
+    Streams large lab extract files into the database.
+
+    The pipeline is a chain of generators: rows are read and validated one at a
+    time, grouped by patient_id into batches of about batch_size rows, and
+    each batch is upserted with one bulk write (and optionally evaluated against
+    the compiled rulebase) before the next row is read. Nothing is read ahead
+    of the consumer, so memory stays bounded by one batch whatever the file
+    size, and a slow database slows reading down instead of filling a buffer.
+    """
+
+    def __init__(self, db, batch_size=1000, evaluate=False):
+        """
+        Initializes the LabFileIngestion.
+
+        :param db: DatabaseManager instance.
+        :param batch_size: Number of rows after which a batch is closed at the next patient.
+        :param evaluate: Whether to evaluate every patient's rows of a batch.
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.evaluate = evaluate
+        self.patients = db.get_collection(lab_values_collection)
+        self.report = IngestionReport()
+
+    def parsed_rows(self, rows):
+        """
+        Validates and converts rows, skipping and logging invalid ones.
+
+        :param rows: Iterator of row dictionaries.
+        :return: Iterator of parse_row results.
+        """
+        for row in rows:
+            self.report.rows_read += 1
+            try:
+                yield parse_row(row)
+            except (ValueError, TypeError) as e:
+                self.report.rows_invalid += 1
+                logging.warning(f"Skipping invalid row {self.report.rows_read}: {e}")
+
+    def batches(self, parsed_rows):
+        """
+        Groups parsed rows by patient into batches of about batch_size rows.
+
+        A batch is only closed where the patient_id changes, so a patient's
+        consecutive rows always end up in the same batch and are evaluated
+        together; a batch exceeds batch_size by the rows of its last patient.
+        Rows of one patient should therefore be contiguous in the file, as they
+        are in HL7-like extracts.
+
+        :param parsed_rows: Iterator of parse_row results.
+        :return: Iterator of dictionaries patient_id -> {'age', 'gender', 'lab_values'}.
+        """
+        batch, size, current = {}, 0, None
+        for patient_id, age, gender, lab_value in parsed_rows:
+            if size >= self.batch_size and patient_id != current:
+                yield batch
+                batch, size = {}, 0
+            current = patient_id
+            patient = batch.setdefault(patient_id, {'age': age, 'gender': gender, 'lab_values': []})
+            patient['lab_values'].append(lab_value)
+            size += 1
+        if batch:
+            yield batch
+
+    def write_batch(self, batch):
+        """
+        Upserts a batch: patients are created if new, their lab values appended and
+        their stored results marked stale. Bucketed readings are written before the
+        patients' lab_values_revision is bumped (see refresh_patient_results).
+
+        :param batch: Dictionary patient_id -> {'age', 'gender', 'lab_values'}.
+        """
+        store = self.db.lab_reading_store
+        patient_operations, reading_operations = [], []
+        for patient_id, patient in batch.items():
+            update = {'$setOnInsert': {'age': patient['age'], 'gender': patient['gender']},
+                      '$set': {'results_valid_until': STALE_HORIZON},
+                      '$inc': {'lab_values_revision': 1}}
+            if store is None:
+                update['$push'] = {'lab_values': {'$each': patient['lab_values']}}
+            else:
+                reading_operations.extend(store.bucket_updates(patient_id, patient['lab_values']))
+            patient_operations.append(UpdateOne({'patient_id': patient_id}, update, upsert=True))
+
+        if reading_operations:
+            store.collection.bulk_write(reading_operations, ordered=False)
+        self.patients.bulk_write(patient_operations, ordered=False)
+
+    def ingest(self, lab_file, file_format='csv'):
+        """
+        Runs the pipeline over a file, one batch per iteration.
+
+        :param lab_file: Open text file.
+        :param file_format: 'csv' or 'hl7'.
+        :return: Iterator of (batch, results) tuples; results maps patient_id to the
+                 matching diseases of the batch's rows when evaluating, else it is empty.
+                 Patients whose evaluation fails are logged, counted as patients_failed
+                 and left out of results; their rows are written all the same.
+        """
+        rows = READERS[file_format](lab_file)
+        for batch in self.batches(self.parsed_rows(rows)):
+            self.write_batch(batch)
+            results = {}
+            if self.evaluate:
+                for patient_id, patient in batch.items():
+                    try:
+                        results[patient_id] = self.db.evaluate_lab_values(patient['age'], patient['gender'], patient['lab_values'])
+                    except Exception as e:
+                        self.report.patients_failed += 1
+                        logging.error(f"Evaluating patient {patient_id} failed: {e}")
+                        continue
+                    self.report.matches += len(results[patient_id])
+
+            self.report.batches += 1
+            self.report.patients_written += len(batch)
+            self.report.rows_written += sum(len(patient['lab_values']) for patient in batch.values())
+            logging.info(f"Ingestion progress: {self.report.to_dict()}")
+            yield batch, results
+
+    def run(self, path, file_format='csv', results_file=None):
+        """
+        Ingests a whole file.
+
+        :param path: Path of the lab extract.
+        :param file_format: 'csv' or 'hl7'.
+        :param results_file: Open text file receiving one JSON line per evaluated patient, or None.
+        :return: IngestionReport instance.
+        """
+        with open(path, 'r', newline='') as lab_file:
+            for _, results in self.ingest(lab_file, file_format):
+                if results_file is not None:
+                    for patient_id, matches in results.items():
+                        results_file.write(json.dumps({'patient_id': patient_id, 'results': matches}) + '\n')
+        return self.report
+
+
+if __name__ == '__main__':
+    from databasemanager import DatabaseManager
+
+    parser = argparse.ArgumentParser(description='Ingest a CSV or HL7-like lab extract file.')
+    parser.add_argument('path', help='Path of the lab extract.')
+    parser.add_argument('--format', choices=sorted(READERS), default='csv', help='File format.')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Rows per batch, exceeded to keep a patient in one batch.')
+    parser.add_argument('--evaluate', action='store_true', help='Evaluate every batch against the rulebase.')
+    parser.add_argument('--results', help='Write the evaluation results to this JSON lines file.')
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager(config.mongodb_link, 'ExpertSystem')
+    ingestion = LabFileIngestion(db_manager, args.batch_size, args.evaluate or bool(args.results))
+    if args.results:
+        with open(args.results, 'w') as results_file:
+            report = ingestion.run(args.path, args.format, results_file)
+    else:
+        report = ingestion.run(args.path, args.format)
+    logging.info(f"Ingestion finished: {report.to_dict()}")
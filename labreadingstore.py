@@ -0,0 +1,182 @@
+import argparse
+import logging
+from pymongo import UpdateOne
+import config
+from config import lab_values_collection, lab_readings_collection, lab_readings_bucket_size
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class LabReadingStore:
+    """
+    Stores lab readings in buckets instead of one ever-growing array on the
+    patient document.
+
+    A bucket holds the readings of one patient and parameter within one
+    calendar month ('window', e.g. '2024-05') as parallel arrays of times,
+    values, units and valid_until dates. Readings are appended in chunks of at
+    most bucket_size, and a chunk only goes into a bucket with room for all of
+    it; otherwise it opens a new one. No bucket ever holds more than
+    bucket_size readings, so documents stay small and a range query over one parameter's history only reads the
+    buckets of the requested months.
+    """
+
+    def __init__(self, db, bucket_size=lab_readings_bucket_size):
+        """
+        Initializes the LabReadingStore with the given database.
+
+        :param db: DatabaseManager instance.
+        :param bucket_size: Maximum number of readings per bucket.
+        """
+        self.collection = db.get_collection(lab_readings_collection)
+        self.bucket_size = bucket_size
+
+    @staticmethod
+    def window(time):
+        """
+        :param time: Time of a reading ('YYYY-MM-DD').
+        :return: Window of the bucket holding the reading ('YYYY-MM').
+        """
+        return time[:7]
+
+    def append(self, patient_id, lab_values):
+        """
+        Appends readings to the patient's buckets, one update per parameter and window.
+
+        :param patient_id: ID of the patient.
+        :param lab_values: List of lab value dictionaries as built by save_lab_values.
+        """
+        operations = self.bucket_updates(patient_id, lab_values)
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+    def bucket_updates(self, patient_id, lab_values):
+        """
+        Builds the bucket upserts appending readings, one per parameter, window and
+        chunk of at most bucket_size readings.
+
+        :param patient_id: ID of the patient.
+        :param lab_values: List of lab value dictionaries as built by save_lab_values.
+        :return: List of UpdateOne operations for bulk_write.
+        """
+        groups = {}
+        for lab_value in lab_values:
+            key = (lab_value['parameter_name'], self.window(lab_value['time']))
+            groups.setdefault(key, []).append(lab_value)
+
+        chunks = [(key, readings[start:start + self.bucket_size])
+                  for key, readings in groups.items() for start in range(0, len(readings), self.bucket_size)]
+        return [UpdateOne(
+            {'patient_id': patient_id, 'parameter_name': parameter_name, 'window': window,
+             'count': {'$lte': self.bucket_size - len(readings)}},
+            {'$push': {
+                'times': {'$each': [reading['time'] for reading in readings]},
+                'values': {'$each': [float(reading['value']) for reading in readings]},
+                'units': {'$each': [reading['unit'] for reading in readings]},
+                'valid_untils': {'$each': [reading['valid_until'] for reading in readings]}
+             },
+             '$inc': {'count': len(readings)}},
+            upsert=True
+        ) for (parameter_name, window), readings in chunks]
+
+    def find_buckets(self, query, start=None, end=None):
+        """
+        Expands the buckets matching a query into lab value dictionaries.
+
+        :param query: Filter on patient_id and/or parameter_name.
+        :param start: Earliest reading time to return ('YYYY-MM-DD'), or None.
+        :param end: Latest reading time to return ('YYYY-MM-DD'), or None.
+        :return: Iterator of (patient_id, lab value dictionary) tuples.
+        """
+        query = dict(query)
+        if start is not None or end is not None:
+            query['window'] = {}
+            if start is not None:
+                query['window']['$gte'] = self.window(start)
+            if end is not None:
+                query['window']['$lte'] = self.window(end)
+
+        buckets = self.collection.find(query).sort([('patient_id', 1), ('parameter_name', 1), ('window', 1)])
+        for bucket in buckets:
+            for time, value, unit, valid_until in zip(bucket['times'], bucket['values'], bucket['units'], bucket['valid_untils']):
+                if (start is not None and time < start) or (end is not None and time > end):
+                    continue
+                yield bucket['patient_id'], {
+                    'parameter_name': bucket['parameter_name'],
+                    'value': value,
+                    'unit': unit,
+                    'valid_until': valid_until,
+                    'time': time
+                }
+
+    def get_lab_values(self, patient_id, parameter_name=None, start=None, end=None):
+        """
+        Returns a patient's readings, optionally of one parameter within a time range.
+
+        :param patient_id: ID of the patient.
+        :param parameter_name: Parameter to return, or None for all parameters.
+        :param start: Earliest reading time ('YYYY-MM-DD'), or None.
+        :param end: Latest reading time ('YYYY-MM-DD'), or None.
+        :return: List of lab value dictionaries.
+        """
+        query = {'patient_id': patient_id}
+        if parameter_name is not None:
+            query['parameter_name'] = parameter_name
+        return [lab_value for _, lab_value in self.find_buckets(query, start, end)]
+
+    def get_all_lab_values(self):
+        """
+        Returns the readings of all patients, read in a single query.
+
+        :return: Dictionary of patient_id -> list of lab value dictionaries.
+        """
+        lab_values = {}
+        for patient_id, lab_value in self.find_buckets({}):
+            lab_values.setdefault(patient_id, []).append(lab_value)
+        return lab_values
+
+    def migrate(self, patients):
+        """
+        Moves the embedded lab_values arrays of all patient documents into buckets.
+
+        Each patient's readings are appended to the buckets, then exactly that many
+        readings are cut from the front of the patient's array, so readings pushed
+        by a concurrent writer in the meantime stay on the document. The field is
+        removed only once the array is empty. Patients that received readings during
+        the migration keep them and are migrated by the next run; a patient
+        interrupted between appending and cutting is migrated again and must be
+        checked for duplicate readings.
+
+        :param patients: The patient collection (User_Input_Lab_Values).
+        :return: Tuple (number of patients, number of readings) migrated.
+        """
+        migrated_patients = migrated_readings = remaining_patients = 0
+        for patient in patients.find({'lab_values': {'$exists': True}}, {'patient_id': 1, 'lab_values': 1}):
+            count = len(patient['lab_values'])
+            if count:
+                self.append(patient['patient_id'], patient['lab_values'])
+                # Writers only ever push to the end of the array, so its first count readings are the migrated ones
+                patients.update_one({'_id': patient['_id']},
+                                    [{'$set': {'lab_values': {'$slice': ['$lab_values', count, 2 ** 31 - 1]}}}])
+            result = patients.update_one({'_id': patient['_id'], 'lab_values': {'$size': 0}}, {'$unset': {'lab_values': ''}})
+            if not result.modified_count:
+                remaining_patients += 1
+            migrated_patients += 1
+            migrated_readings += count
+            logging.debug(f"Migrated {count} readings of patient {patient['patient_id']}")
+        if remaining_patients:
+            logging.warning(f"{remaining_patients} patients received new embedded readings during the migration, run it again")
+        return migrated_patients, migrated_readings
+
+if __name__ == '__main__':
+    from databasemanager import DatabaseManager
+
+    parser = argparse.ArgumentParser(description='Manage the bucketed lab reading storage.')
+    parser.add_argument('--migrate', action='store_true', help='Move embedded lab_values arrays into buckets.')
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager(config.mongodb_link, 'ExpertSystem')
+    if args.migrate:
+        patients, readings = LabReadingStore(db_manager).migrate(db_manager.get_collection(lab_values_collection))
+        logging.info(f"Migrated {readings} readings of {patients} patients")
@@ -0,0 +1,108 @@
+import datetime
+import logging
+import threading
+import config
+from config import lab_values_collection
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class ResultSweeper(threading.Thread):
+    """
+    Background thread re-evaluating the patients whose stored results may have
+    changed because a supporting lab value expired.
+
+    Every stored result carries a results_valid_until horizon (the earliest
+    valid_until among the lab values supporting its matches). Each sweep reads
+    only the patients whose horizon has passed, through the index on that field,
+    and re-evaluates them; saving new lab values sets the horizon to
+    STALE_HORIZON, so those patients are picked up by the next sweep too.
+    Patients without an expiring match keep no horizon and are never swept.
+
+    A patient whose re-evaluation fails is logged and skipped; the sweep goes on
+    with the next one. Run the sweeper in one process only: either enable
+    sweep_results in a single web worker, or leave it off and run this module
+    from cron, which does one sweep per run.
+    """
+
+    def __init__(self, db, interval=3600.0):
+        """
+        Initializes the ResultSweeper.
+
+        :param db: DatabaseManager whose patient results are kept up to date.
+        :param interval: Seconds between sweeps.
+        """
+        super().__init__(name='ResultSweeper', daemon=True)
+        self.db = db
+        self.interval = interval
+        self.sweeps = 0
+        self.patients_refreshed = 0
+        self.patients_failed = 0
+        self.last_sweep = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """
+        Stops the sweeper after the current sweep.
+        """
+        self._stop_event.set()
+
+    def stats(self):
+        """
+        :return: Dictionary describing the sweeps done so far.
+        """
+        return {
+            'alive': self.is_alive(),
+            'interval': self.interval,
+            'sweeps': self.sweeps,
+            'patients_refreshed': self.patients_refreshed,
+            'patients_failed': self.patients_failed,
+            'last_sweep': self.last_sweep,
+        }
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Result sweep failed: {e}")
+            self._stop_event.wait(self.interval)
+
+    def sweep(self):
+        """
+        Re-evaluates every patient whose results_valid_until horizon has passed.
+
+        :return: Number of patients re-evaluated.
+        """
+        today = str(datetime.date.today())
+        collection = self.db.get_collection(lab_values_collection)
+        expired = [patient['patient_id'] for patient in
+                   collection.find({'results_valid_until': {'$lt': today}}, {'patient_id': 1})]
+        refreshed = failed = 0
+        for patient_id in expired:
+            if self._stop_event.is_set():
+                break
+            try:
+                patient = self.db.get_patient(patient_id)
+                if patient:
+                    self.db.refresh_patient_results(patient)
+                    refreshed += 1
+            except Exception as e:
+                failed += 1
+                logging.error(f"Re-evaluating patient {patient_id} failed: {e}")
+
+        self.sweeps += 1
+        self.patients_refreshed += refreshed
+        self.patients_failed += failed
+        self.last_sweep = datetime.datetime.now().isoformat(timespec='seconds')
+        logging.info(f"Result sweep re-evaluated {refreshed} patients with expired results, {failed} failed")
+        return refreshed
+
+
+if __name__ == '__main__':
+    from databasemanager import DatabaseManager
+
+    # A single sweep, e.g. from cron
+    db_manager = DatabaseManager(config.mongodb_link, 'ExpertSystem')
+    ResultSweeper(db_manager).sweep()
@@ -5,7 +5,7 @@ class RuleAggregator:
     Aggregates rules for a specific disease category.
     """
 
-    def __init__(self, category, disease_name, disease_code, rules, _id=None):
+    def __init__(self, category, disease_name, disease_code, rules, _id=None, stored_rules=None):
         """
         Initializes the RuleAggregator with the given parameters.
         
@@ -14,12 +14,15 @@ class RuleAggregator:
         :param disease_code: Code of the disease.
         :param rules: List of RuleEntry objects.
         :param _id: MongoDB ObjectId (optional).
+        :param stored_rules: Rule entry dictionaries as stored, if rules holds the pruned
+                             entries evaluated in their place (optional).
         """
         self.category = category
         self.disease_name = disease_name
         self.disease_code = disease_code
         self.rules = rules
         self._id = _id
+        self.stored_rules = stored_rules
 
     def to_dict(self):
         """
@@ -27,13 +30,16 @@ class RuleAggregator:
         
         :return: Dictionary representation of the instance.
         """
-        return {
+        data = {
             'category': self.category,
             'disease_name': self.disease_name,
             'disease_code': self.disease_code,
             'rules': [rule.to_dict() for rule in self.rules],
             '_id': self._id
         }
+        if self.stored_rules is not None:
+            data['stored_rules'] = self.stored_rules
+        return data
 # WHy you define the classmethod
     @classmethod
     def from_dict(cls, data):
@@ -49,9 +55,24 @@ class RuleAggregator:
             disease_name=data.get('disease_name'),
             disease_code=data.get('disease_code'),
             rules=rules,
-            _id=data.get('_id')
+            _id=data.get('_id'),
+            stored_rules=data.get('stored_rules')
         )
 
+    @staticmethod
+    def stored_entry(stored_rules, rule_entry_data):
+        """
+        Returns the stored form of a (possibly pruned) rule entry.
+
+        :param stored_rules: Rule entry dictionaries as stored, or None.
+        :param rule_entry_data: Dictionary of the evaluated rule entry.
+        :return: The stored entry with the same rule_id, or rule_entry_data if there is none.
+        """
+        for stored in stored_rules or ():
+            if stored['rule_id'] == rule_entry_data['rule_id']:
+                return stored
+        return rule_entry_data
+
 class RuleEntry:
     """
     Represents a single rule entry with an ID and associated conditions.
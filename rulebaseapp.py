@@ -1,6 +1,7 @@
 from flask import current_app
 from bson import ObjectId
 from ruleaggregator import RuleAggregator
+from rulevalidator import RuleValidator, RuleValidationError
 from config import rules_data_collection
 
 class RulebaseApp:
@@ -14,6 +15,7 @@ class RulebaseApp:
         
         :param db: DatabaseManager instance.
         """
+        self.db = db
         self.collection = db.get_collection(rules_data_collection)
 
     def save_rule(self, rule):
@@ -21,9 +23,16 @@ class RulebaseApp:
         Saves a rule to the database.
         
         :param rule: RuleAggregator object to be saved.
+        :return: List of notes on what was normalized, or is pruned when the rule is evaluated.
+        :raises RuleValidationError: If the rule is invalid.
         """
+        rule_data, notes = RuleValidator().validate_rule(rule.to_dict(), prune=False)
+        for note in notes:
+            current_app.logger.info(f'Rule for {rule.disease_code}: {note}')
         current_app.logger.info(f'Saving rule: {rule}')
-        self.collection.insert_one(rule.to_dict())
+        self.collection.insert_one(rule_data)
+        self.db.bump_rulebase_version()
+        return notes
     
     def get_all_rules(self):
         rules = self.collection.find()
@@ -80,6 +89,7 @@ class RulebaseApp:
         :param disease_code: Disease code of the rule to be deleted.
         """
         self.collection.delete_one({'disease_code': disease_code})
+        self.db.bump_rulebase_version()
 
     def get_rule_by_id(self, rule_id):
         """
@@ -103,8 +113,15 @@ class RulebaseApp:
         :param disease_name: List of disease names.
         :param disease_code: List of disease codes.
         :param rules: List of rule entries.
-        :return: Dictionary indicating success or failure.
+        :return: Dictionary indicating success or failure, with the validation notes on success.
         """
+        try:
+            rules, notes = RuleValidator().validate_entries(rules, prune=False)
+        except RuleValidationError as e:
+            return {'status': 'error', 'message': f'Invalid rule: {e}'}
+        for note in notes:
+            current_app.logger.info(f'Rule {rule_id}: {note}')
+
         result = self.collection.update_one(
             {'_id': ObjectId(rule_id)},
             {'$set': {
@@ -116,6 +133,7 @@ class RulebaseApp:
         )
 
         if result.modified_count > 0:
-            return {'status': 'success', 'message': 'Rule updated successfully'}
+            self.db.bump_rulebase_version()
+            return {'status': 'success', 'message': 'Rule updated successfully', 'notes': notes}
         else:
             return {'status': 'error', 'message': 'Failed to update rule'}
\ No newline at end of file
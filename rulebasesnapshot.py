@@ -0,0 +1,268 @@
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+from compiledrulebase import CompiledRulebase, NODE_FREE
+from conditioncompiler import ConditionCompiler
+from ruleaggregator import RuleAggregator
+from thresholdindex import ThresholdIndex
+from unitnormalizer import UnitNormalizer
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Snapshot file layout (native byte order, every section aligned to 8 bytes):
+#   header:  magic, format version, byte order mark, rulebase version, condition count, section count
+#   table:   one (name, typecode, offset, length) record per section
+#   data:    the sections; typecode 'x' marks a raw bytes blob, anything else an array() typecode
+MAGIC = b'ICDRULES'
+FORMAT_VERSION = 3
+BYTE_ORDER_MARK = 0x01020304
+HEADER = struct.Struct('=8sIIqqI')
+SECTION = struct.Struct('=16sc7xqq')
+
+
+class SnapshotError(Exception):
+    """
+    Raised when a snapshot file cannot be read.
+    """
+
+
+class SnapshotRulebase(CompiledRulebase):
+    """
+    Read-only CompiledRulebase backed by a memory-mapped snapshot file.
+
+    The node arrays, threshold indexes and AND/OR structure are memoryviews into
+    the mapping, so worker processes loading the same file share its pages.
+    Disease descriptions are decoded only for matching rule entries. Call thaw()
+    to get a CompiledRulebase that supports incremental updates.
+    """
+
+    def __init__(self, normalizer, mapping, sections, version, condition_count):
+        """
+        Initializes the SnapshotRulebase from the sections of a mapped snapshot.
+
+        :param normalizer: UnitNormalizer to resolve parameter IDs with.
+        :param mapping: The mmap object (kept open for the lifetime of the rulebase).
+        :param sections: Dictionary of section name -> memoryview.
+        :param version: Rulebase version the snapshot was built from.
+        :param condition_count: Number of distinct conditions in the snapshot.
+        """
+        super().__init__(normalizer=normalizer)
+        self.version = version
+        self._mapping = mapping
+        self._sections = sections
+        self._condition_count = condition_count
+
+        self._kind = sections['kind']
+        self._age_min = sections['age_min']
+        self._age_max = sections['age_max']
+        self._gender = sections['gender']
+
+        strings = json.loads(bytes(sections['strings']))
+        self._genders = {gender: i for i, gender in enumerate(strings['genders'])}
+        self._generic = {int(node): ConditionCompiler.from_dict(condition)
+                         for node, condition in strings['generic'].items()}
+
+        # index_starts holds, per parameter, the start of its slice in every ThresholdIndex array section
+        starts, width = sections['index_starts'], len(ThresholdIndex.ARRAYS)
+        for i, parameter in enumerate(strings['parameters']):
+            self._indexes[normalizer.register_parameter(parameter)] = ThresholdIndex.from_arrays(*(
+                sections[f'ix_{name}'][starts[i * width + j]:starts[(i + 1) * width + j]]
+                for j, (name, _) in enumerate(ThresholdIndex.ARRAYS)))
+
+    def __len__(self):
+        return len(self._sections['disease_entries']) - 1
+
+    @property
+    def rules(self):
+        """
+        :return: List of RuleAggregator objects decoded from the snapshot.
+        """
+        entry_bounds = self._sections['disease_entries']
+        rules = []
+        for disease in range(len(self)):
+            data = self._decode('disease_offsets', 'diseases', disease)
+            data['rules'] = [self._decode('entry_offsets', 'entries', entry)
+                             for entry in range(entry_bounds[disease], entry_bounds[disease + 1])]
+            rules.append(RuleAggregator.from_dict(data))
+        return rules
+
+    @property
+    def condition_count(self):
+        return self._condition_count
+
+    def thaw(self):
+        """
+        :return: A mutable CompiledRulebase compiled from the snapshot's rules.
+        """
+        compiled = CompiledRulebase(self.rules, self.normalizer)
+        compiled.version = self.version
+        return compiled
+
+    def add_rule(self, rule):
+        raise TypeError("SnapshotRulebase is read-only, call thaw() first")
+
+    def remove_rule(self, rule_id):
+        raise TypeError("SnapshotRulebase is read-only, call thaw() first")
+
+    def _decode(self, offsets_section, blob_section, i):
+        offsets = self._sections[offsets_section]
+        return json.loads(bytes(self._sections[blob_section][offsets[i]:offsets[i + 1]]))
+
+    def _diseases(self):
+        entry_bounds = self._sections['disease_entries']
+        node_bounds = self._sections['entry_nodes']
+        nodes = self._sections['nodes']
+        for disease in range(len(self)):
+            yield disease, ((entry, nodes[node_bounds[entry]:node_bounds[entry + 1]])
+                            for entry in range(entry_bounds[disease], entry_bounds[disease + 1]))
+
+    def _describe(self, disease, entry):
+        data = self._decode('disease_offsets', 'diseases', disease)
+        return {
+            'disease_code': data['disease_code'],
+            'disease_name': data['disease_name'],
+            'category': data['category'],
+            'matching_rule': RuleAggregator.stored_entry(data['stored_rules'],
+                                                         self._decode('entry_offsets', 'entries', entry))
+        }
+
+    def _entry_data(self, disease, entry):
+        return (self._decode('entry_offsets', 'entries', entry),
+                self._decode('disease_offsets', 'diseases', disease)['stored_rules'])
+
+
+def _json_lines(documents):
+    """
+    Concatenates JSON documents into one blob.
+
+    :param documents: Iterable of JSON-serializable objects.
+    :return: Tuple (offsets array, blob bytes).
+    """
+    offsets = array('q', [0])
+    blob = bytearray()
+    for document in documents:
+        blob += json.dumps(document).encode('utf-8')
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+
+def write_snapshot(compiled, path, version):
+    """
+    Serializes a compiled rulebase. The file is written next to the target and
+    moved into place atomically, so readers never see a partial snapshot.
+
+    :param compiled: CompiledRulebase to serialize.
+    :param path: Path of the snapshot file.
+    :param version: Rulebase version the compiled rulebase was built from.
+    """
+    compiled = compiled.thaw()
+    genders = [None] * len(compiled._genders)
+    for gender, i in compiled._genders.items():
+        genders[i] = gender
+
+    parameters = []
+    index_arrays = {name: array(typecode) for name, typecode in ThresholdIndex.ARRAYS}
+    index_starts = array('q', [0] * len(ThresholdIndex.ARRAYS))
+    for parameter_id, index in compiled._indexes.items():
+        parameters.append(compiled.normalizer.parameter_name(parameter_id))
+        for (name, _), values in zip(ThresholdIndex.ARRAYS, index.arrays()):
+            index_arrays[name].extend(values)
+            index_starts.append(len(index_arrays[name]))
+
+    disease_entries, entry_nodes, nodes = array('q', [0]), array('q', [0]), array('i')
+    entry_documents = []
+    for rule, entries in compiled._rules.values():
+        for rule_entry, entry_node_ids in entries:
+            nodes.extend(entry_node_ids)
+            entry_nodes.append(len(nodes))
+            entry_documents.append(rule_entry.to_dict())
+        disease_entries.append(len(entry_nodes) - 1)
+    disease_offsets, diseases = _json_lines(
+        {'_id': str(rule._id), 'category': rule.category, 'disease_name': rule.disease_name,
+         'disease_code': rule.disease_code, 'stored_rules': rule.stored_rules} for rule, _ in compiled._rules.values())
+    entry_offsets, entries = _json_lines(entry_documents)
+
+    strings = {
+        'parameters': parameters,
+        'genders': genders,
+        'generic': {str(node): condition.to_dict() for node, condition in compiled._generic.items()},
+    }
+    sections = {
+        'kind': array('B', [kind if kind is not None else NODE_FREE for kind in compiled._kind]),
+        'age_min': array('d', [value or 0 for value in compiled._age_min]),
+        'age_max': array('d', [value or 0 for value in compiled._age_max]),
+        'gender': array('i', [value or 0 for value in compiled._gender]),
+        'index_starts': index_starts,
+        **{f'ix_{name}': values for name, values in index_arrays.items()},
+        'disease_entries': disease_entries,
+        'entry_nodes': entry_nodes,
+        'nodes': nodes,
+        'disease_offsets': disease_offsets,
+        'diseases': diseases,
+        'entry_offsets': entry_offsets,
+        'entries': entries,
+        'strings': json.dumps(strings).encode('utf-8'),
+    }
+
+    position = HEADER.size + SECTION.size * len(sections)
+    table, payload = [], []
+    for name, data in sections.items():
+        raw = data if isinstance(data, bytes) else data.tobytes()
+        typecode = b'x' if isinstance(data, bytes) else data.typecode.encode()
+        padding = -position % 8
+        position += padding
+        table.append(SECTION.pack(name.encode(), typecode, position, len(raw)))
+        payload.append(b'\0' * padding + raw)
+        position += len(raw)
+
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, BYTE_ORDER_MARK, version,
+                                        compiled.condition_count, len(sections)))
+        snapshot_file.writelines(table)
+        snapshot_file.writelines(payload)
+    os.replace(temporary_path, path)
+    logging.debug(f"Wrote rulebase snapshot version {version} with {len(compiled)} rules to {path}")
+
+
+def load_snapshot(path, version=None, normalizer=None):
+    """
+    Memory-maps a snapshot file.
+
+    :param path: Path of the snapshot file.
+    :param version: Expected rulebase version, or None to accept any.
+    :param normalizer: UnitNormalizer to use (defaults to the one built from mappings.json).
+    :return: SnapshotRulebase, or None if the file is missing or has another version.
+    :raises SnapshotError: If the file is not a valid snapshot.
+    """
+    try:
+        with open(path, 'rb') as snapshot_file:
+            mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    view = memoryview(mapping)
+    if len(view) < HEADER.size:
+        raise SnapshotError(f"{path} is too short to be a rulebase snapshot")
+    magic, format_version, byte_order_mark, snapshot_version, condition_count, section_count = HEADER.unpack_from(view)
+    if magic != MAGIC or format_version != FORMAT_VERSION or byte_order_mark != BYTE_ORDER_MARK:
+        raise SnapshotError(f"{path} is not a rulebase snapshot of format {FORMAT_VERSION} for this platform")
+    if version is not None and snapshot_version != version:
+        logging.debug(f"Snapshot {path} has version {snapshot_version}, expected {version}")
+        return None
+
+    try:
+        sections = {}
+        for i in range(section_count):
+            name, typecode, offset, length = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+            if offset < 0 or length < 0 or offset + length > len(view):
+                raise SnapshotError(f"{path} is truncated")
+            data = view[offset:offset + length]
+            sections[name.rstrip(b'\0').decode()] = data if typecode == b'x' else data.cast(typecode.decode())
+        return SnapshotRulebase(normalizer or UnitNormalizer.default(), mapping, sections, snapshot_version, condition_count)
+    except (struct.error, ValueError, TypeError, KeyError, IndexError) as e:
+        raise SnapshotError(f"{path} is not a valid rulebase snapshot: {e!r}") from e
@@ -0,0 +1,241 @@
+import datetime
+import logging
+import threading
+import time
+from pymongo.errors import OperationFailure
+from ruleaggregator import RuleAggregator
+from rulevalidator import RuleValidator, RuleValidationError
+from rulebasesnapshot import SnapshotRulebase
+from config import rules_data_collection, rulebase_meta_collection
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Server error code returned when change streams are unavailable (standalone server)
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+
+class RulebaseWatcher(threading.Thread):
+    """
+    Background thread keeping a worker's compiled rulebase in sync with the
+    Rulebase collection, so requests no longer read MongoDB to find out whether
+    the rulebase changed.
+
+    On replica sets a change stream is watched and every insert, update,
+    replace and delete is applied to the compiled rulebase incrementally. On
+    standalone servers the rulebase version document is polled instead and the
+    rulebase is reloaded (from the shared snapshot) when the version changes.
+
+    The change stream also carries the updates of the rulebase version
+    document, in commit order with the rule writes. Every rule write is
+    committed before its version bump, so when the bump to version V is applied
+    all rule changes up to V have been applied as well, and only then is the
+    rulebase stamped with V. Between the two the rulebase keeps the previous
+    version, so results evaluated against it are never labelled with a version
+    they do not contain.
+
+    Errors (lost connections, a failed reload) are logged and the watcher
+    retries after poll_interval seconds, in either mode.
+
+    Applying a change thaws the memory-mapped snapshot into a private copy of
+    this worker. Once no change has arrived for settle_interval seconds, the
+    rulebase is reloaded from the snapshot of the current version, so the
+    workers share its pages again.
+
+    Staleness is measured as the time between a change being committed and it
+    being applied in this worker; the last and maximum values are available
+    through stats().
+    """
+
+    def __init__(self, db, poll_interval=5.0, settle_interval=30.0):
+        """
+        Initializes the RulebaseWatcher.
+
+        :param db: DatabaseManager whose compiled rulebase is kept up to date.
+        :param poll_interval: Seconds between version checks when change streams are unavailable.
+        :param settle_interval: Seconds without changes after which a thawed rulebase is
+                                replaced by the shared snapshot again.
+        """
+        super().__init__(name='RulebaseWatcher', daemon=True)
+        self.db = db
+        self.poll_interval = poll_interval
+        self.settle_interval = settle_interval
+        self.mode = None
+        self.events_applied = 0
+        self.last_staleness = None
+        self.max_staleness = 0.0
+        self.validator = RuleValidator()
+        self._thawed_since = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """
+        Registers the watcher with the DatabaseManager and starts watching for changes.
+        """
+        self.db.rulebase_watcher = self
+        super().start()
+
+    def stop(self):
+        """
+        Stops the watcher. Requests fall back to checking the rulebase version themselves.
+        """
+        self._stop_event.set()
+        self.db.rulebase_watcher = None
+
+    def stats(self):
+        """
+        :return: Dictionary describing the watcher state and measured staleness in seconds.
+        """
+        rulebase = self.db.compiled_rulebase
+        return {
+            'mode': self.mode,
+            'alive': self.is_alive(),
+            'rulebase_version': rulebase.version if rulebase is not None else None,
+            'rules': len(rulebase) if rulebase is not None else 0,
+            'shared_snapshot': isinstance(rulebase, SnapshotRulebase),
+            'events_applied': self.events_applied,
+            'last_staleness': self.last_staleness,
+            'max_staleness': self.max_staleness,
+            'poll_interval': self.poll_interval,
+        }
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.mode == 'polling':
+                    self._poll_version()
+                else:
+                    self._watch_change_stream()
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    logging.info("Change streams are not supported, polling the rulebase version instead")
+                    self.mode = 'polling'
+                    continue
+                logging.error(f"Rulebase watcher failed, retrying: {e}")
+                self._stop_event.wait(self.poll_interval)
+            except Exception as e:
+                logging.error(f"Rulebase watcher failed, retrying: {e}")
+                self._stop_event.wait(self.poll_interval)
+
+    def _watch_change_stream(self):
+        """
+        Opens a change stream on the Rulebase collection and the rulebase version
+        document, reloads the rulebase and applies every change until the watcher
+        is stopped. The stream is opened before the reload so no change committed
+        in between is missed.
+        """
+        pipeline = [{'$match': {'ns.coll': {'$in': [rules_data_collection, rulebase_meta_collection]}}}]
+        with self.db.db.watch(pipeline, full_document='updateLookup', max_await_time_ms=1000) as stream:
+            self.mode = 'change_stream'
+            self._reload()
+            while not self._stop_event.is_set() and stream.alive:
+                change = stream.try_next()
+                if change is None:
+                    self._settle()
+                    continue
+                self._apply_change(change)
+
+    def _apply_change(self, change):
+        """
+        Applies a single change stream event to the compiled rulebase.
+
+        :param change: Change stream document.
+        """
+        if change.get('ns', {}).get('coll') == rulebase_meta_collection:
+            self._apply_version(change)
+            return
+
+        operation = change['operationType']
+        with self.db.rulebase_lock:
+            if self.db.compiled_rulebase is None:
+                self._reload()  # A failed reload left no rulebase; the new one includes this change
+                return
+            rulebase = self.db.compiled_rulebase.thaw()
+            if operation in ('insert', 'update', 'replace'):
+                if change.get('fullDocument') is None:
+                    return  # Deleted before the lookup; the delete event follows
+                try:
+                    rule_data, _ = self.validator.validate_rule(change['fullDocument'])
+                    rulebase.update_rule(RuleAggregator.from_dict(rule_data))
+                except RuleValidationError as e:
+                    logging.error(f"Dropping invalid rule {change['documentKey']['_id']}: {e}")
+                    rulebase.remove_rule(change['documentKey']['_id'])
+            elif operation == 'delete':
+                rulebase.remove_rule(change['documentKey']['_id'])
+            else:
+                logging.info(f"Rulebase change stream reported {operation}, reloading")
+                self._reload()
+                return
+            self.db.compiled_rulebase = rulebase
+        self._thawed_since = time.monotonic()
+
+        committed = change.get('wallTime')
+        if committed is None:
+            committed = change['clusterTime'].as_datetime().replace(tzinfo=None)
+        self._record_staleness(committed)
+        logging.debug(f"Applied rulebase {operation} of {change['documentKey']['_id']}")
+
+    def _apply_version(self, change):
+        """
+        Stamps the compiled rulebase with the version of a rulebase version document event.
+        All rule changes committed before the bump have been applied by then.
+
+        :param change: Change stream document on the rulebase version document.
+        """
+        document = change.get('fullDocument')
+        if change['documentKey']['_id'] != 'rulebase_version' or document is None:
+            return
+        with self.db.rulebase_lock:
+            if self.db.compiled_rulebase is not None:
+                self.db.compiled_rulebase.version = document['version']
+        logging.debug(f"Rulebase is at version {document['version']}")
+
+    def _settle(self):
+        """
+        Reloads the shared snapshot once no change has been applied for settle_interval seconds.
+        """
+        if self._thawed_since is None or time.monotonic() - self._thawed_since < self.settle_interval:
+            return
+        logging.info("Rulebase changes settled, reloading the shared snapshot")
+        self._reload()
+
+    def _poll_version(self):
+        """
+        Polls the rulebase version document and reloads the rulebase when it changes.
+        """
+        self.mode = 'polling'
+        self._reload()
+        while not self._stop_event.wait(self.poll_interval):
+            document = self.db.get_rulebase_version_document()
+            rulebase = self.db.compiled_rulebase
+            if rulebase is not None and document['version'] == rulebase.version:
+                continue
+            self._reload()
+            if document.get('updated_at') is not None:
+                self._record_staleness(document['updated_at'])
+
+    def _reload(self):
+        """
+        Replaces the compiled rulebase with the one of the current version. If that
+        fails, the previous rulebase stays in place and the error is raised.
+        """
+        with self.db.rulebase_lock:
+            previous = self.db.compiled_rulebase
+            self.db.compiled_rulebase = None
+            try:
+                self.db.get_compiled_rulebase()
+            except Exception:
+                self.db.compiled_rulebase = previous
+                raise
+        self._thawed_since = None
+
+    def _record_staleness(self, committed):
+        """
+        Records the delay between a change being committed and being applied.
+
+        :param committed: Commit time of the change (naive UTC datetime).
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        self.last_staleness = max((now - committed).total_seconds(), 0.0)
+        self.max_staleness = max(self.max_staleness, self.last_staleness)
+        self.events_applied += 1
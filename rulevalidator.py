@@ -0,0 +1,377 @@
+import argparse
+import logging
+import math
+import config
+from config import rules_data_collection, rule_max_age
+from conditioncompiler import ConditionCompiler
+from ruleaggregator import RuleEntry
+from unitnormalizer import UnitNormalizer, UNKNOWN_PARAMETER
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Spellings of the condition types found in stored rules, mapped to the canonical type
+CONDITION_TYPES = {
+    'range': 'range',
+    'comparison': 'comparison',
+    'time-dependent': 'time-dependent',
+    'timedependent': 'time-dependent',
+    'time dependent': 'time-dependent',
+    'time dependent condition': 'time-dependent',
+}
+OPERATORS = ('greater', 'less', 'equal', 'greater or equal', 'less or equal')
+GENDERS = ('all', 'male', 'female')
+
+
+class RuleValidationError(ValueError):
+    """
+    Raised when a rule cannot be normalized into one the evaluator accepts.
+    """
+
+    def __init__(self, problems):
+        """
+        Initializes the RuleValidationError with the problems found.
+
+        :param problems: List of problem descriptions.
+        """
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+
+class RuleValidator:
+    """
+    Normalizes rules before they are stored or compiled, so the evaluator only
+    ever sees well-formed conditions.
+
+    Every condition gets a canonical type, a numeric age range (missing limits
+    become 0 and max_age), a known gender and numeric bounds; a range with a
+    single bound becomes the equivalent comparison. Conditions that cannot be
+    repaired (unknown type or operator, missing comparison value or time) make
+    the rule invalid.
+
+    Conditions that can never be met (an empty range, an age band with
+    age_min > age_max) make their rule entry unsatisfiable, as do conditions of
+    one entry whose age bands or genders exclude each other; such entries are
+    pruned. Within an entry, a condition implied by another one (same parameter,
+    narrower interval, narrower age band and gender) is redundant and pruned,
+    and a rule entry implied by an earlier entry of the same disease can never
+    be the first match and is pruned as well. A rule left without entries is
+    invalid.
+
+    Pruning only applies to the compiled form: rules are stored normalized but
+    unpruned (prune=False), so editing a rule later still shows every entry
+    and condition its author wrote, and the notes tell what evaluation drops.
+    A pruned rule keeps its unpruned entries as 'stored_rules', which results
+    and explanations describe matches with.
+    """
+
+    def __init__(self, max_age=rule_max_age, normalizer=None):
+        """
+        Initializes the RuleValidator.
+
+        :param max_age: Upper age limit given to conditions without one.
+        :param normalizer: UnitNormalizer to compare bounds in different units with.
+        """
+        self.max_age = max_age
+        self.normalizer = normalizer or UnitNormalizer.default()
+
+    def validate_rule(self, rule_data, prune=True):
+        """
+        Validates and normalizes a rule document.
+
+        :param rule_data: Rule dictionary as stored in the Rulebase collection.
+        :param prune: Whether to drop the entries and conditions that can never make a difference;
+                      if any are dropped, the unpruned entries are kept as 'stored_rules'.
+        :return: Tuple (normalized rule dictionary, list of notes on what was changed or pruned).
+        :raises RuleValidationError: If the rule is invalid.
+        """
+        problems = [f"{field} is missing" for field in ('category', 'disease_name', 'disease_code')
+                    if not rule_data.get(field)]
+        try:
+            kept, entries, notes = self._validate_entries(rule_data.get('rules') or [])
+        except RuleValidationError as e:
+            problems.extend(e.problems)
+        if problems:
+            raise RuleValidationError(problems)
+
+        normalized = dict(rule_data)
+        normalized.pop('stored_rules', None)
+        normalized['rules'] = entries
+        if prune and kept != entries:
+            normalized['rules'] = kept
+            # Kept in the form matching rules are described in (RuleEntry.to_dict)
+            normalized['stored_rules'] = [RuleEntry.from_dict(entry).to_dict() for entry in entries]
+        return normalized, notes
+
+    def validate_entries(self, entries, prune=True):
+        """
+        Validates and normalizes the rule entries of a disease and prunes the
+        ones that can never be the first match.
+
+        :param entries: List of rule entry dictionaries.
+        :param prune: Whether to drop the entries and conditions that can never make a difference;
+                      if not, they are only reported in the notes.
+        :return: Tuple (normalized rule entry dictionaries, list of notes on what was changed or pruned).
+        :raises RuleValidationError: If an entry is invalid or no entry can ever match.
+        """
+        kept, normalized, notes = self._validate_entries(entries)
+        return (kept if prune else normalized), notes
+
+    def _validate_entries(self, entries):
+        """
+        Validates and normalizes rule entries, and prunes a copy of them.
+
+        :param entries: List of rule entry dictionaries.
+        :return: Tuple (pruned entries, normalized entries, list of notes).
+        :raises RuleValidationError: If an entry is invalid or no entry can ever match.
+        """
+        problems, notes, kept, normalized = [], [], [], []
+        for entry in entries:
+            rule_id = entry.get('rule_id')
+            conditions = []
+            for position, condition in enumerate(entry.get('conditions') or [], start=1):
+                try:
+                    conditions.append(self.normalize_condition(condition, f"rule {rule_id}, condition {position}", notes))
+                except RuleValidationError as e:
+                    problems.extend(e.problems)
+            if not entry.get('conditions'):
+                problems.append(f"rule {rule_id} has no conditions")
+            if problems:
+                continue
+            normalized.append({'rule_id': rule_id, 'conditions': conditions})
+
+            reason = self._unsatisfiable(conditions)
+            if reason is not None:
+                notes.append(f"rule {rule_id} pruned: {reason}")
+                continue
+            conditions = self._prune_implied(conditions, f"rule {rule_id}", notes)
+
+            earlier = next((other for other in kept if self._entry_implies(conditions, other['conditions'])), None)
+            if earlier is not None:
+                notes.append(f"rule {rule_id} pruned: implied by rule {earlier['rule_id']}")
+                continue
+            kept.append({'rule_id': rule_id, 'conditions': conditions})
+
+        if not problems and not kept:
+            problems.append("no rule entry can ever match" if entries else "the disease has no rules")
+        if problems:
+            raise RuleValidationError(problems)
+        return kept, normalized, notes
+
+    def normalize_condition(self, condition, where, notes):
+        """
+        Normalizes a single condition.
+
+        :param condition: Condition dictionary.
+        :param where: Description of the condition's position, used in messages.
+        :param notes: List receiving notes on what was changed.
+        :return: Normalized condition dictionary.
+        :raises RuleValidationError: If the condition cannot be normalized.
+        """
+        problems = []
+        condition_type = CONDITION_TYPES.get(str(condition.get('type') or '').strip().lower())
+        if condition_type is None:
+            raise RuleValidationError([f"{where}: unknown condition type {condition.get('type')!r}"])
+
+        parameter = condition.get('parameter')
+        if not isinstance(parameter, str) or not parameter.strip():
+            problems.append(f"{where}: parameter is missing")
+        unit = condition.get('unit')
+        gender = str(condition.get('gender') or 'all').strip().lower()
+        if gender not in GENDERS:
+            problems.append(f"{where}: unknown gender {condition.get('gender')!r}")
+
+        age_min = self._number(condition.get('age_min'), int, f"{where}: age_min", problems)
+        age_max = self._number(condition.get('age_max'), int, f"{where}: age_max", problems)
+        if age_min is None:
+            age_min = 0
+        if age_max is None:
+            age_max = self.max_age
+        if age_min < 0:
+            problems.append(f"{where}: age_min is negative")
+
+        normalized = {
+            'type': condition_type,
+            'parameter': parameter.strip() if isinstance(parameter, str) else parameter,
+            'unit': (unit.strip() or None) if isinstance(unit, str) else unit,
+            'age_min': age_min,
+            'age_max': age_max,
+            'gender': gender
+        }
+
+        if condition_type == 'range':
+            min_value = self._number(condition.get('min_value'), float, f"{where}: min_value", problems)
+            max_value = self._number(condition.get('max_value'), float, f"{where}: max_value", problems)
+            if min_value is None and max_value is None and not problems:
+                problems.append(f"{where}: range has no bounds")
+            elif min_value is None or max_value is None:
+                normalized['type'] = 'comparison'
+                normalized['operator'] = 'greater or equal' if max_value is None else 'less or equal'
+                normalized['comparison_value'] = min_value if max_value is None else max_value
+                notes.append(f"{where}: range with a single bound stored as a comparison")
+            else:
+                normalized.update({'min_value': min_value, 'max_value': max_value})
+        else:
+            operator = condition.get('operator')
+            if operator not in OPERATORS:
+                problems.append(f"{where}: unknown operator {operator!r}")
+            value_field = 'comparison_value' if condition_type == 'comparison' else 'comparison_time_value'
+            value = self._number(condition.get(value_field), float, f"{where}: {value_field}", problems)
+            if value is None:
+                problems.append(f"{where}: {value_field} is missing")
+            normalized.update({'operator': operator, value_field: value})
+            if condition_type == 'time-dependent':
+                time = self._number(condition.get('time'), int, f"{where}: time", problems)
+                if time is None or time < 0:
+                    problems.append(f"{where}: time must be a non-negative number of days")
+                normalized['time'] = time
+
+        if problems:
+            raise RuleValidationError(problems)
+        return normalized
+
+    @staticmethod
+    def _number(value, kind, what, problems):
+        """
+        Converts a form or database value to a number.
+
+        :param value: Value to convert; None and '' mean missing.
+        :param kind: int or float.
+        :param what: Description of the value, used in messages.
+        :param problems: List receiving a problem if the value is not a finite number.
+        :return: The converted number, or None if it is missing or invalid.
+        """
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return None
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            problems.append(f"{what} is not a number: {value!r}")
+            return None
+        if not math.isfinite(number) or (kind is int and not number.is_integer()):
+            problems.append(f"{what} is not a valid {'whole ' if kind is int else ''}number: {value!r}")
+            return None
+        return kind(number)
+
+    def _interval(self, condition):
+        """
+        :param condition: Normalized condition dictionary.
+        :return: Tuple (parameter key, interval in the canonical unit), or None for time-dependent
+                 conditions. The key is the parameter ID, or the lowercased name of parameters
+                 that are not registered with the normalizer.
+        """
+        interval = ConditionCompiler.from_dict(condition).interval()
+        if interval is None:
+            return None
+        parameter_id = self.normalizer.parameter_id(condition['parameter'])
+        if parameter_id == UNKNOWN_PARAMETER:
+            return condition['parameter'].lower(), interval
+        low, high, low_inclusive, high_inclusive = interval
+        if low != float('-inf'):
+            low = self.normalizer.convert(parameter_id, condition['unit'], low)
+        if high != float('inf'):
+            high = self.normalizer.convert(parameter_id, condition['unit'], high)
+        return parameter_id, (low, high, low_inclusive, high_inclusive)
+
+    def _unsatisfiable(self, conditions):
+        """
+        :param conditions: Normalized conditions of one rule entry.
+        :return: Why the entry can never match, or None if it can.
+        """
+        for condition in conditions:
+            if condition['age_min'] > condition['age_max']:
+                return f"impossible age band {condition['age_min']}-{condition['age_max']} for {condition['parameter']}"
+            interval = self._interval(condition)
+            if interval is not None:
+                low, high, low_inclusive, high_inclusive = interval[1]
+                if low > high or (low == high and not (low_inclusive and high_inclusive)):
+                    return f"empty range for {condition['parameter']}"
+
+        if max(condition['age_min'] for condition in conditions) > min(condition['age_max'] for condition in conditions):
+            return "the age bands of its conditions do not overlap"
+        if len({condition['gender'] for condition in conditions} - {'all'}) > 1:
+            return "its conditions require different genders"
+        return None
+
+    def _implies(self, condition, other):
+        """
+        Checks whether a patient meeting condition always meets other as well.
+
+        :param condition: Normalized condition dictionary.
+        :param other: Normalized condition dictionary.
+        :return: Boolean.
+        """
+        if condition == other:
+            return True
+        if not (other['age_min'] <= condition['age_min'] and condition['age_max'] <= other['age_max']):
+            return False
+        if other['gender'] != 'all' and other['gender'] != condition['gender']:
+            return False
+        interval, other_interval = self._interval(condition), self._interval(other)
+        if interval is None or other_interval is None or interval[0] != other_interval[0]:
+            return False
+
+        low, high, low_inclusive, high_inclusive = interval[1]
+        other_low, other_high, other_low_inclusive, other_high_inclusive = other_interval[1]
+        low_inside = low > other_low or (low == other_low and (other_low_inclusive or not low_inclusive))
+        high_inside = high < other_high or (high == other_high and (other_high_inclusive or not high_inclusive))
+        return low_inside and high_inside
+
+    def _prune_implied(self, conditions, where, notes):
+        """
+        Drops the conditions of an entry that are implied by another condition of it.
+
+        :param conditions: Normalized conditions of one rule entry.
+        :param where: Description of the entry, used in notes.
+        :param notes: List receiving a note per pruned condition.
+        :return: List of the remaining conditions, in their original order.
+        """
+        kept = []
+        for condition in conditions:
+            if any(self._implies(other, condition) for other in kept):
+                notes.append(f"{where}: redundant condition on {condition['parameter']} pruned")
+                continue
+            for other in [other for other in kept if self._implies(condition, other)]:
+                notes.append(f"{where}: redundant condition on {other['parameter']} pruned")
+                kept.remove(other)
+            kept.append(condition)
+        return kept
+
+    def _entry_implies(self, conditions, other_conditions):
+        """
+        Checks whether a patient matching an entry always matches another entry as well.
+
+        :param conditions: Normalized conditions of the entry.
+        :param other_conditions: Normalized conditions of the other entry.
+        :return: Boolean.
+        """
+        return all(any(self._implies(condition, other) for condition in conditions) for other in other_conditions)
+
+
+if __name__ == '__main__':
+    from databasemanager import DatabaseManager
+
+    parser = argparse.ArgumentParser(description='Validate the rules stored in the Rulebase collection.')
+    parser.add_argument('--fix', action='store_true', help='Store the normalized (unpruned) form of every valid rule.')
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager(config.mongodb_link, 'ExpertSystem')
+    collection = db_manager.get_collection(rules_data_collection)
+    validator = RuleValidator()
+    invalid = changed = 0
+    for document in collection.find():
+        try:
+            normalized, notes = validator.validate_rule(document, prune=False)
+        except RuleValidationError as e:
+            invalid += 1
+            logging.error(f"Rule {document['_id']} ({document.get('disease_code')}) is invalid: {e}")
+            continue
+        for note in notes:
+            logging.info(f"Rule {document['_id']} ({document.get('disease_code')}): {note}")
+        if normalized != document:
+            changed += 1
+            if args.fix:
+                collection.replace_one({'_id': document['_id']}, normalized)
+    if args.fix and changed:
+        db_manager.bump_rulebase_version()
+    logging.info(f"{invalid} invalid rules, {changed} rules {'normalized' if args.fix else 'to normalize'}")
@@ -0,0 +1,260 @@
+import argparse
+import datetime
+import json
+import logging
+import re
+import config
+from config import lab_values_collection, screening_reports_collection
+from compiledrulebase import CompiledRulebase
+from unitnormalizer import UnitNormalizer, UNKNOWN_PARAMETER
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class ScreeningReport:
+    """
+    Counts how many patients currently match each disease, broken down by age
+    band and gender.
+
+    Diseases whose rule entries consist only of range and comparison
+    conditions are translated into $match/$elemMatch filters and counted by
+    MongoDB itself, many diseases per collection pass through $facet. The other
+    diseases (time-dependent conditions, parameters stored in units that need a
+    conversion) are counted by evaluating the patients against a
+    CompiledRulebase of just those diseases. Which units need a conversion is
+    decided from the unit spellings actually stored for each parameter, read
+    once per report, so lab values in a unit mappings.json does not list are
+    converted exactly as the evaluator converts them.
+
+    Reports are cached in the Screening_Reports collection, keyed by the
+    rulebase version, the age band width and the day (lab values expire daily).
+    Changes to patient data do not invalidate a report; pass refresh=True to
+    recompute it.
+    """
+
+    def __init__(self, db, age_band=10, facet_size=100, normalizer=None):
+        """
+        Initializes the ScreeningReport.
+
+        :param db: DatabaseManager instance.
+        :param age_band: Width of the age bands in years.
+        :param facet_size: Number of diseases counted per aggregation.
+        :param normalizer: UnitNormalizer to use (defaults to the one built from mappings.json).
+        :raises ValueError: If age_band is smaller than 1.
+        """
+        if age_band < 1:
+            raise ValueError(f"age_band must be at least 1, got {age_band}")
+        self.db = db
+        self.age_band = age_band
+        self.facet_size = facet_size
+        self.normalizer = normalizer or UnitNormalizer.default()
+        self.patients = db.get_collection(lab_values_collection)
+        self.reports = db.get_collection(screening_reports_collection)
+        self._stored_units = None
+
+    def get_report(self, refresh=False):
+        """
+        Returns the report for the current rulebase version, computing it if it is not cached.
+
+        :param refresh: Whether to recompute a cached report.
+        :return: Report dictionary.
+        """
+        version = self.db.get_rulebase_version()
+        today = str(datetime.date.today())
+        key = f'{version}:{self.age_band}:{today}'
+        if not refresh:
+            cached = self.reports.find_one({'_id': key})
+            if cached:
+                logging.debug(f"Using cached screening report {key}")
+                return cached
+
+        report = {
+            '_id': key,
+            'rulebase_version': version,
+            'date': today,
+            'age_band': self.age_band,
+            'diseases': self.compute(self.db.get_all_rules(), today)
+        }
+        self.reports.replace_one({'_id': key}, report, upsert=True)
+        return report
+
+    def compute(self, rules, today):
+        """
+        Counts the matching patients of every rule.
+
+        :param rules: List of RuleAggregator objects.
+        :param today: Current date ('YYYY-MM-DD'); lab values valid until before it are ignored.
+        :return: List of per-disease dictionaries, in the order of rules.
+        """
+        filters, fallback = {}, []
+        self._stored_units = None
+        for position, rule in enumerate(rules):
+            rule_filter = self.rule_filter(rule, today) if self.db.lab_reading_store is None else None
+            if rule_filter is None:
+                fallback.append((position, rule))
+            else:
+                filters[position] = rule_filter
+
+        breakdowns = self.aggregate(filters)
+        breakdowns.update(self.evaluate([rule for _, rule in fallback], [position for position, _ in fallback]))
+
+        diseases = []
+        for position, rule in enumerate(rules):
+            breakdown = breakdowns.get(position, [])
+            diseases.append({
+                'disease_code': rule.disease_code,
+                'disease_name': rule.disease_name,
+                'category': rule.category,
+                'method': 'aggregation' if position in filters else 'evaluation',
+                'total': sum(group['count'] for group in breakdown),
+                'breakdown': breakdown
+            })
+        logging.debug(f"Screened {len(filters)} diseases in MongoDB and {len(fallback)} by evaluation")
+        return diseases
+
+    def rule_filter(self, rule, today):
+        """
+        Translates a rule into a filter on patient documents.
+
+        :param rule: RuleAggregator object.
+        :param today: Current date ('YYYY-MM-DD').
+        :return: Filter dictionary, or None if a condition cannot be translated.
+        """
+        entries = []
+        for rule_entry in rule.rules:
+            conditions = [self.condition_filter(condition, today) for condition in rule_entry.conditions]
+            if any(condition is None for condition in conditions):
+                return None
+            entries.append({'$and': conditions} if conditions else {})
+        if not entries:
+            return {'_id': {'$exists': False}}
+        return {'$or': entries}
+
+    def condition_filter(self, condition, today):
+        """
+        Translates a range or comparison condition into a filter on patient documents.
+
+        :param condition: ConditionCompiler instance.
+        :param today: Current date ('YYYY-MM-DD').
+        :return: Filter dictionary, or None if the condition cannot be translated.
+        """
+        interval = condition.interval()
+        if interval is None:
+            return None
+
+        parameter_id = self.normalizer.parameter_id(condition.parameter)
+        if parameter_id == UNKNOWN_PARAMETER:
+            names = [condition.parameter]
+        else:
+            names, _ = self.normalizer.spellings(parameter_id)
+        factor = self.normalizer.factor(parameter_id, condition.unit)
+        if any(self.normalizer.factor(parameter_id, unit) != factor for unit in self.stored_units(parameter_id)):
+            return None  # Stored lab values need a conversion the database cannot do
+
+        low, high, low_inclusive, high_inclusive = interval
+        value = {}
+        if low != float('-inf'):
+            value['$gte' if low_inclusive else '$gt'] = low
+        if high != float('inf'):
+            value['$lte' if high_inclusive else '$lt'] = high
+
+        pattern = '^(' + '|'.join(re.escape(name) for name in names) + ')$'
+        lab_value = {'parameter_name': {'$regex': pattern, '$options': 'i'}, 'valid_until': {'$gte': today}}
+        if value:
+            lab_value['value'] = value
+        condition_filter = {
+            'age': {'$gte': condition.age_min, '$lte': condition.age_max},
+            'lab_values': {'$elemMatch': lab_value}
+        }
+        if condition.gender != 'all':
+            condition_filter['gender'] = condition.gender
+        return condition_filter
+
+    def stored_units(self, parameter_id):
+        """
+        Returns the unit spellings stored for a parameter's lab values. All spellings are
+        read in one aggregation the first time, and kept until the next compute.
+
+        :param parameter_id: Integer parameter ID.
+        :return: Set of unit spellings.
+        """
+        if self._stored_units is None:
+            self._stored_units = {}
+            pairs = self.patients.aggregate([
+                {'$unwind': '$lab_values'},
+                {'$group': {'_id': {'parameter_name': '$lab_values.parameter_name', 'unit': '$lab_values.unit'}}}
+            ])
+            for pair in pairs:
+                known_id = self.normalizer.parameter_id(pair['_id'].get('parameter_name') or '')
+                if known_id != UNKNOWN_PARAMETER:
+                    self._stored_units.setdefault(known_id, set()).add(pair['_id'].get('unit'))
+        return self._stored_units.get(parameter_id, set())
+
+    def aggregate(self, filters):
+        """
+        Counts the patients matching each filter by age band and gender in MongoDB.
+
+        :param filters: Dictionary of rule position -> filter.
+        :return: Dictionary of rule position -> breakdown list.
+        """
+        group = [
+            {'$group': {
+                '_id': {'age_band': {'$subtract': ['$age', {'$mod': ['$age', self.age_band]}]}, 'gender': '$gender'},
+                'count': {'$sum': 1}
+            }},
+            {'$sort': {'_id.age_band': 1, '_id.gender': 1}}
+        ]
+        positions = list(filters)
+        breakdowns = {}
+        for start in range(0, len(positions), self.facet_size):
+            chunk = positions[start:start + self.facet_size]
+            facets = {str(position): [{'$match': filters[position]}] + group for position in chunk}
+            result = next(self.patients.aggregate([{'$facet': facets}]), {})
+            for position in chunk:
+                breakdowns[position] = [self._group(row['_id']['age_band'], row['_id']['gender'], row['count'])
+                                        for row in result.get(str(position), [])]
+        return breakdowns
+
+    def evaluate(self, rules, positions):
+        """
+        Counts the patients matching each rule by evaluating every patient, streamed one at a time.
+
+        :param rules: List of RuleAggregator objects that cannot be counted in MongoDB.
+        :param positions: Position of each rule in the report.
+        :return: Dictionary of rule position -> breakdown list.
+        """
+        if not rules:
+            return {}
+        compiled = CompiledRulebase(rules, self.normalizer)
+        position_of = {id(rule): position for rule, position in zip(rules, positions)}
+        counts = {}
+        for patient in self.db.iter_patients():
+            age_band = patient['age'] - patient['age'] % self.age_band
+            for rule in compiled.match(patient['age'], patient['gender'], patient.get('lab_values', [])):
+                key = (position_of[id(rule)], age_band, patient['gender'])
+                counts[key] = counts.get(key, 0) + 1
+
+        breakdowns = {}
+        for (position, age_band, gender), count in sorted(counts.items(), key=lambda item: (item[0][0], item[0][1], str(item[0][2]))):
+            breakdowns.setdefault(position, []).append(self._group(age_band, gender, count))
+        return breakdowns
+
+    def _group(self, age_band, gender, count):
+        return {
+            'age_band': f'{age_band}-{age_band + self.age_band - 1}' if age_band is not None else None,
+            'gender': gender,
+            'count': count
+        }
+
+
+if __name__ == '__main__':
+    from databasemanager import DatabaseManager
+
+    parser = argparse.ArgumentParser(description='Count the patients currently matching each disease.')
+    parser.add_argument('--age-band', type=int, default=10, help='Width of the age bands in years.')
+    parser.add_argument('--refresh', action='store_true', help='Recompute a cached report.')
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager(config.mongodb_link, 'ExpertSystem')
+    print(json.dumps(ScreeningReport(db_manager, args.age_band).get_report(args.refresh), indent=2, default=str))
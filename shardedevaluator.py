@@ -0,0 +1,216 @@
+import logging
+import multiprocessing
+import threading
+from compiledrulebase import CompiledRulebase
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def _shard_worker(connection):
+    """
+    Main loop of a shard process. Holds one CompiledRulebase shard and answers
+    'load', 'evaluate' and 'stop' messages received over the connection. An
+    exception raised while handling a message is sent back as the reply.
+
+    :param connection: Connection end of a multiprocessing Pipe.
+    """
+    shard = CompiledRulebase()
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return
+        command = message[0]
+        if command == 'stop':
+            return
+        try:
+            if command == 'load':
+                _, normalizer, rules = message
+                shard = CompiledRulebase(rules, normalizer)
+                connection.send(('ok', len(shard)))
+            elif command == 'evaluate':
+                _, patient_age, patient_gender, lab_values, normalized = message
+                connection.send(('ok', shard.evaluate(patient_age, patient_gender, lab_values, normalized)))
+            else:
+                connection.send(('error', f"Unknown command {command}"))
+        except Exception as e:
+            try:
+                connection.send(('error', e))
+            except Exception:
+                connection.send(('error', repr(e)))  # The exception cannot be pickled
+
+
+class ShardError(Exception):
+    """
+    Raised when a shard process fails or reports an error.
+    """
+
+
+class ShardedEvaluator:
+    """
+    Evaluates patients against very large rulebases on several cores.
+
+    The diseases of a rulebase are independent of each other, so the rulebase is
+    cut into contiguous shards of about the same number of conditions and each
+    shard is compiled inside its own long-lived worker process. A patient's lab
+    values are normalized once in the calling process, the normalized view is
+    sent to every shard, and the shards' matches are concatenated in shard order,
+    which is the order a single CompiledRulebase would report them in.
+
+    Rulebases with fewer than min_rules diseases are evaluated in the calling
+    process, where the message round trips would cost more than they save.
+
+    Shards are rebuilt whenever the rulebase object, its version or its revision
+    changes. The worker processes are forked when the evaluator is created, so
+    create it before the process starts threads or opens connections.
+
+    An exception raised by a shard (e.g. a lab value with an invalid date) is
+    raised to the caller, just as evaluating in-process would; the pool stays
+    up. Only if the connection to a worker breaks does the evaluator shut the
+    pool down and evaluate in-process from then on.
+    """
+
+    def __init__(self, workers, min_rules=20000):
+        """
+        Initializes the ShardedEvaluator and starts its worker processes.
+
+        :param workers: Number of worker processes (and shards).
+        :param min_rules: Smallest rulebase, in diseases, evaluated in the worker processes.
+        """
+        self.min_rules = min_rules
+        self._lock = threading.Lock()
+        self._source = None
+        self._loaded = None
+        self._connections = []
+        self._processes = []
+
+        context = multiprocessing.get_context('fork')
+        for i in range(workers):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=_shard_worker, args=(child_connection,),
+                                      name=f'RulebaseShard-{i}', daemon=True)
+            process.start()
+            child_connection.close()
+            self._connections.append(parent_connection)
+            self._processes.append(process)
+        logging.info(f"Started {workers} rulebase shard processes")
+
+    @property
+    def workers(self):
+        return len(self._processes)
+
+    def stats(self):
+        """
+        :return: Dictionary describing the pool and the currently loaded shards.
+        """
+        return {
+            'workers': self.workers,
+            'min_rules': self.min_rules,
+            'rulebase_version': self._loaded[0] if self._loaded else None,
+            'rulebase_revision': self._loaded[1] if self._loaded else None,
+        }
+
+    def evaluate(self, rulebase, patient_age, patient_gender, lab_values):
+        """
+        Evaluates the patient's lab values against the rulebase, across the shards
+        if the rulebase is large enough.
+
+        :param rulebase: CompiledRulebase to evaluate against.
+        :param patient_age: Age of the patient.
+        :param patient_gender: Gender of the patient.
+        :param lab_values: List of lab values for the patient.
+        :return: List of dictionaries describing the matching diseases.
+        :raises Exception: Whatever a shard raised while evaluating.
+        """
+        if not self._processes or len(rulebase) < self.min_rules:
+            return rulebase.evaluate(patient_age, patient_gender, lab_values)
+
+        normalized = rulebase.normalize_lab_values(lab_values)
+        with self._lock:
+            try:
+                self._ensure_loaded(rulebase)
+                results = self._broadcast([('evaluate', patient_age, patient_gender, lab_values, normalized)])
+            except (OSError, EOFError) as e:
+                logging.error(f"Lost a rulebase shard process, evaluating in-process from now on: {e}")
+                self.close()
+                return rulebase.evaluate(patient_age, patient_gender, lab_values, normalized)
+
+        matching_diseases = []
+        for shard_matches in results:
+            matching_diseases.extend(shard_matches)
+        return matching_diseases
+
+    def _ensure_loaded(self, rulebase):
+        """
+        Splits the rulebase into shards and loads them into the workers, unless they hold it already.
+
+        :param rulebase: CompiledRulebase to evaluate against.
+        """
+        if self._source is rulebase and self._loaded == (rulebase.version, rulebase.revision):
+            return
+
+        rules = rulebase.rules
+        weights = [sum(len(rule_entry.conditions) for rule_entry in rule.rules) or 1 for rule in rules]
+        total = sum(weights)
+        shards = [[] for _ in self._processes]
+        cumulative = 0
+        for rule, weight in zip(rules, weights):
+            shards[min(cumulative * len(shards) // total, len(shards) - 1)].append(rule)
+            cumulative += weight
+
+        # The normalizer is sent along so the shards resolve parameter names to the same IDs
+        self._source = self._loaded = None
+        sizes = self._broadcast([('load', rulebase.normalizer, shard) for shard in shards])
+        self._source = rulebase
+        self._loaded = (rulebase.version, rulebase.revision)
+        logging.info(f"Loaded rulebase version {rulebase.version} into shards of {sizes} diseases")
+
+    def _broadcast(self, messages):
+        """
+        Sends one message to every worker, then collects the replies. Every worker a
+        message reached is read from before anything is raised, so the pipes stay in step.
+
+        :param messages: List with one message per worker, or a single message for all of them.
+        :return: List of reply payloads, in worker order.
+        :raises OSError, EOFError: If the connection to a worker is broken.
+        :raises Exception: The first exception a worker replied with, or ShardError if it
+                           could not be sent back.
+        """
+        if len(messages) == 1:
+            messages = messages * len(self._connections)
+        error, sent = None, 0
+        try:
+            for connection, message in zip(self._connections, messages):
+                connection.send(message)
+                sent += 1
+        except (OSError, EOFError):
+            raise
+        except Exception as e:
+            error = e  # e.g. a message that cannot be pickled; the workers already sent to still reply
+
+        payloads = []
+        for connection in self._connections[:sent]:
+            status, payload = connection.recv()
+            if status == 'ok':
+                payloads.append(payload)
+            elif error is None:
+                error = payload if isinstance(payload, Exception) else ShardError(payload)
+        if error is not None:
+            raise error
+        return payloads
+
+    def close(self):
+        """
+        Stops the worker processes. Later evaluations run in the calling process.
+        """
+        for connection in self._connections:
+            try:
+                connection.send(('stop',))
+            except OSError:
+                pass
+            connection.close()
+        for process in self._processes:
+            process.join(timeout=5)
+        self._connections, self._processes = [], []
+        self._source = self._loaded = None
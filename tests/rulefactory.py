@@ -0,0 +1,93 @@
+import datetime
+import random
+from ruleaggregator import RuleAggregator
+
+PARAMETERS = ['potassium', 'ALT', 'sodium']
+OPERATORS = ['greater', 'less', 'equal', 'greater or equal', 'less or equal']
+
+
+def random_condition(rng):
+    """
+    :param rng: random.Random instance.
+    :return: Random condition dictionary on one of PARAMETERS.
+    """
+    condition_type = rng.choice(['range', 'comparison', 'comparison', 'time-dependent'])
+    condition = {
+        'type': condition_type,
+        'parameter': rng.choice(PARAMETERS),
+        'unit': 'mmol/l',
+        'age_min': rng.choice([0, 18, 40]),
+        'age_max': rng.choice([17, 60, 120]),
+        'gender': rng.choice(['all', 'male', 'female'])
+    }
+    if condition_type == 'range':
+        low = rng.randint(0, 10)
+        condition.update(min_value=float(low), max_value=float(low + rng.randint(-1, 4)))
+    elif condition_type == 'comparison':
+        condition.update(operator=rng.choice(OPERATORS), comparison_value=float(rng.randint(0, 10)))
+    else:
+        condition.update(operator=rng.choice(OPERATORS), comparison_time_value=float(rng.randint(0, 10)),
+                         time=rng.randint(0, 5))
+    return condition
+
+
+def random_rules(rng, count=30):
+    """
+    :param rng: random.Random instance.
+    :param count: Number of diseases.
+    :return: List of RuleAggregator objects with one to three entries of one to three conditions.
+    """
+    return [RuleAggregator.from_dict({
+        '_id': f'id{i}',
+        'category': 'c',
+        'disease_name': f'd{i}',
+        'disease_code': f'C{i}',
+        'rules': [{'rule_id': j + 1, 'conditions': [random_condition(rng) for _ in range(rng.randint(1, 3))]}
+                  for j in range(rng.randint(1, 3))]
+    }) for i in range(count)]
+
+
+def random_lab_values(rng):
+    """
+    :param rng: random.Random instance.
+    :return: List of zero to six lab value dictionaries around today.
+    """
+    today = datetime.date.today()
+    return [{
+        'parameter_name': rng.choice(PARAMETERS + ['Potassium']),
+        'value': float(rng.randint(0, 10)),
+        'unit': 'mmol/l',
+        'valid_until': str(today + datetime.timedelta(days=rng.randint(-3, 3))),
+        'time': str(today - datetime.timedelta(days=rng.randint(0, 10)))
+    } for _ in range(rng.randint(0, 6))]
+
+
+def random_patients(seed, count):
+    """
+    :param seed: Seed of the random generator.
+    :param count: Number of patients.
+    :return: List of (age, gender, lab values) tuples.
+    """
+    rng = random.Random(seed)
+    return [(rng.randint(0, 100), rng.choice(['male', 'female']), random_lab_values(rng)) for _ in range(count)]
+
+
+def reference_evaluate(rules, patient_age, patient_gender, lab_values):
+    """
+    Evaluates rule by rule and condition by condition, the way the evaluator did
+    before rules were compiled.
+
+    :return: List of dictionaries describing the matching diseases.
+    """
+    matching_diseases = []
+    for rule in rules:
+        for rule_entry in rule.rules:
+            if all(condition.evaluate(patient_age, patient_gender, lab_values) for condition in rule_entry.conditions):
+                matching_diseases.append({
+                    'disease_code': rule.disease_code,
+                    'disease_name': rule.disease_name,
+                    'category': rule.category,
+                    'matching_rule': rule_entry.to_dict()
+                })
+                break
+    return matching_diseases
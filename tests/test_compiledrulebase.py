@@ -0,0 +1,86 @@
+import random
+import pytest
+from compiledrulebase import CompiledRulebase
+from ruleaggregator import RuleAggregator
+from rulevalidator import RuleValidator
+from rulefactory import random_rules, random_patients, reference_evaluate
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_evaluate_and_explain_match_baseline(seed):
+    rules = random_rules(random.Random(seed))
+    compiled = CompiledRulebase(rules)
+    for patient in random_patients(seed, 50):
+        expected = reference_evaluate(rules, *patient)
+        assert compiled.evaluate(*patient) == expected
+        assert compiled.explain(*patient).matching_diseases == expected
+
+
+def test_incremental_changes_match_baseline():
+    rng = random.Random(31)
+    rules = random_rules(rng)
+    compiled = CompiledRulebase(rules)
+    for rule in rules[:5]:
+        compiled.remove_rule(str(rule._id))
+    replacement = random_rules(rng, 6)[5]
+    replacement._id = rules[10]._id
+    compiled.update_rule(replacement)
+    expected_rules = [replacement if rule is rules[10] else rule for rule in rules[5:]]
+    for patient in random_patients(31, 50):
+        assert compiled.evaluate(*patient) == reference_evaluate(expected_rules, *patient)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_pruned_rules_match_the_same_diseases(seed):
+    validator = RuleValidator()
+    rules, pruned = random_rules(random.Random(seed)), []
+    for rule in rules:
+        try:
+            normalized, _ = validator.validate_rule(rule.to_dict())
+        except ValueError:
+            normalized = None
+        pruned.append(normalized)
+    compiled = CompiledRulebase([RuleAggregator.from_dict(rule) for rule in pruned if rule is not None])
+    for patient in random_patients(seed, 50):
+        expected = [disease['disease_code'] for disease in reference_evaluate(rules, *patient)]
+        assert [disease['disease_code'] for disease in compiled.evaluate(*patient)] == expected
+
+
+def pruned_rulebase(seed):
+    """
+    :param seed: Seed of the random generator.
+    :return: Tuple (valid rules as stored, CompiledRulebase of their pruned forms).
+    """
+    validator = RuleValidator()
+    stored, pruned = [], []
+    for rule in random_rules(random.Random(seed)):
+        try:
+            normalized, _ = validator.validate_rule(rule.to_dict())
+        except ValueError:
+            continue
+        stored.append(RuleAggregator.from_dict(validator.validate_rule(rule.to_dict(), prune=False)[0]).to_dict())
+        pruned.append(RuleAggregator.from_dict(normalized))
+    assert any(rule.stored_rules is not None for rule in pruned)
+    return stored, CompiledRulebase(pruned)
+
+
+def assert_described_as_stored(rulebase, stored, patient):
+    by_code = {rule['disease_code']: rule for rule in stored}
+    for disease in rulebase.evaluate(*patient):
+        assert disease['matching_rule'] in by_code[disease['disease_code']]['rules']
+    for match in rulebase.explain(*patient).matches:
+        rule = by_code[match.disease_code]
+        assert [outcome.rule_id for outcome in match.entries] == [entry['rule_id'] for entry in rule['rules']]
+        for outcome, entry in zip(match.entries, rule['rules']):
+            assert [condition.condition for condition in outcome.conditions] == entry['conditions']
+            if outcome.met is not None:
+                single = RuleAggregator.from_dict(dict(rule, rules=[entry]))
+                assert outcome.met == bool(reference_evaluate([single], *patient))
+        assert match.matching_rule['rule_id'] == next(outcome.rule_id for outcome in match.entries if outcome.met)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_pruned_rules_are_described_as_stored(seed):
+    stored, compiled = pruned_rulebase(seed)
+    for patient in random_patients(seed, 50):
+        assert_described_as_stored(compiled, stored, patient)
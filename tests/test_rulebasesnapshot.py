@@ -0,0 +1,65 @@
+import random
+import pytest
+from compiledrulebase import CompiledRulebase
+from rulebasesnapshot import SnapshotError, SnapshotRulebase, load_snapshot, write_snapshot
+from rulefactory import random_rules, random_patients, reference_evaluate
+from test_compiledrulebase import assert_described_as_stored, pruned_rulebase
+
+
+@pytest.fixture
+def compiled():
+    rules = random_rules(random.Random(30), 25)
+    rulebase = CompiledRulebase(rules)
+    for rule in rules[:5]:
+        rulebase.remove_rule(str(rule._id))
+    return rulebase
+
+
+def test_round_trip(compiled, tmp_path):
+    path = str(tmp_path / 'rulebase.snapshot')
+    write_snapshot(compiled, path, 4)
+    snapshot = load_snapshot(path, 4)
+    assert isinstance(snapshot, SnapshotRulebase)
+    assert snapshot.version == 4
+    assert len(snapshot) == len(compiled)
+    assert snapshot.condition_count == compiled.condition_count
+    thawed = snapshot.thaw()
+    for patient in random_patients(30, 50):
+        expected = reference_evaluate(compiled.rules, *patient)
+        assert snapshot.evaluate(*patient) == expected
+        assert snapshot.explain(*patient).matching_diseases == expected
+        assert thawed.evaluate(*patient) == expected
+
+
+def test_other_version_is_a_miss(compiled, tmp_path):
+    path = str(tmp_path / 'rulebase.snapshot')
+    write_snapshot(compiled, path, 4)
+    assert load_snapshot(path, 5) is None
+    assert load_snapshot(str(tmp_path / 'missing.snapshot'), 4) is None
+
+
+@pytest.mark.parametrize('corrupt', [
+    lambda data: b'garbage' * 10,
+    lambda data: data[:len(data) // 2],
+    lambda data: data[:16],
+    lambda data: data[:-64] + b'\xff' * 64,
+])
+def test_corrupt_file_raises_snapshot_error(compiled, tmp_path, corrupt):
+    path = tmp_path / 'rulebase.snapshot'
+    write_snapshot(compiled, str(path), 4)
+    path.write_bytes(corrupt(path.read_bytes()))
+    with pytest.raises(SnapshotError):
+        load_snapshot(str(path), 4)
+
+
+def test_pruned_rules_are_described_as_stored(tmp_path):
+    stored, compiled = pruned_rulebase(0)
+    path = str(tmp_path / 'rulebase.snapshot')
+    write_snapshot(compiled, path, 1)
+    snapshot = load_snapshot(path, 1)
+    thawed = snapshot.thaw()
+    for patient in random_patients(0, 50):
+        assert_described_as_stored(snapshot, stored, patient)
+        assert ([match.to_dict() for match in snapshot.explain(*patient).matches]
+                == [match.to_dict() for match in compiled.explain(*patient).matches])
+        assert thawed.evaluate(*patient) == compiled.evaluate(*patient)
@@ -0,0 +1,47 @@
+import random
+import pytest
+from compiledrulebase import CompiledRulebase
+from ruleaggregator import RuleAggregator
+from shardedevaluator import ShardedEvaluator
+from rulefactory import random_rules, random_patients, reference_evaluate
+
+
+@pytest.fixture
+def evaluator():
+    evaluator = ShardedEvaluator(3, min_rules=10)
+    yield evaluator
+    evaluator.close()
+
+
+def time_dependent_rule(position):
+    return RuleAggregator.from_dict({
+        '_id': f'td{position}', 'category': 'c', 'disease_name': f'td{position}', 'disease_code': f'TD{position}',
+        'rules': [{'rule_id': 1, 'conditions': [{
+            'type': 'time-dependent', 'parameter': 'potassium', 'unit': 'mmol/l', 'age_min': 0, 'age_max': 150,
+            'gender': 'all', 'operator': 'greater', 'comparison_time_value': 1.0, 'time': 3}]}]
+    })
+
+
+def test_matches_baseline(evaluator):
+    rules = random_rules(random.Random(36), 40)
+    compiled = CompiledRulebase(rules)
+    for patient in random_patients(36, 30):
+        assert evaluator.evaluate(compiled, *patient) == reference_evaluate(rules, *patient)
+    assert evaluator.workers == 3
+
+
+def test_evaluation_error_is_raised_and_keeps_the_pool(evaluator):
+    rules = [time_dependent_rule(position) for position in range(12)]
+    compiled = CompiledRulebase(rules)
+    bad = [{'parameter_name': 'potassium', 'value': 2.0, 'unit': 'mmol/l', 'valid_until': '2999-01-01',
+            'time': '01/02/2024'}]
+    with pytest.raises(Exception) as in_process:
+        compiled.evaluate(40, 'male', bad)
+    with pytest.raises(type(in_process.value)):
+        evaluator.evaluate(compiled, 40, 'male', bad)
+    assert evaluator.workers == 3
+
+    # The pipes are still in step: the next patient gets its own answer
+    for patient in random_patients(37, 10):
+        assert evaluator.evaluate(compiled, *patient) == reference_evaluate(rules, *patient)
+    assert evaluator.workers == 3
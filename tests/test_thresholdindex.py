@@ -0,0 +1,79 @@
+import random
+import pytest
+from thresholdindex import ThresholdIndex
+
+
+def brute_force(intervals, value):
+    matches = []
+    for key, (low, high, low_inclusive, high_inclusive) in intervals.items():
+        above = value >= low if low_inclusive else value > low
+        below = value <= high if high_inclusive else value < high
+        if above and below:
+            matches.append(key)
+    return sorted(matches)
+
+
+@pytest.mark.parametrize('low_inclusive, high_inclusive, expected', [
+    (True, True, [1.0, 1.5, 2.0]),
+    (False, True, [1.5, 2.0]),
+    (True, False, [1.0, 1.5]),
+    (False, False, [1.5]),
+])
+def test_lookup_respects_open_and_closed_bounds(low_inclusive, high_inclusive, expected):
+    index = ThresholdIndex()
+    index.add(7, 1.0, 2.0, low_inclusive, high_inclusive)
+    assert [value for value in (0.5, 1.0, 1.5, 2.0, 2.5) if index.lookup(value) == [7]] == expected
+
+
+def test_lookup_of_unbounded_and_empty_intervals():
+    index = ThresholdIndex()
+    index.add(1, float('-inf'), 3.0, True, False)
+    index.add(2, 3.0, float('inf'))
+    index.add(3, 4.0, 4.0, True, False)  # Empty, never matches
+    assert index.lookup(-1e300) == [1]
+    assert index.lookup(3.0) == [2]
+    assert index.lookup(4.0) == [2]
+    assert index.lookup(float('nan')) == []
+
+
+def test_remove_and_readd():
+    index = ThresholdIndex()
+    index.add(1, 0.0, 10.0)
+    index.add(2, 5.0, 6.0)
+    assert sorted(index.lookup(5.5)) == [1, 2]
+    index.remove(2)
+    index.remove(42)  # Unknown keys are ignored
+    assert index.lookup(5.5) == [1]
+    assert len(index) == 1
+    index.add(2, 5.0, 6.0)
+    assert sorted(index.lookup(5.5)) == [1, 2]
+
+
+def test_from_arrays_is_read_only_and_equivalent():
+    index = ThresholdIndex()
+    for key in range(20):
+        index.add(key, key, key + 3)
+    copy = ThresholdIndex.from_arrays(*index.arrays())
+    assert len(copy) == 20
+    for value in range(-1, 25):
+        assert sorted(copy.lookup(value)) == sorted(index.lookup(value))
+    with pytest.raises(TypeError):
+        copy.add(99, 0, 1)
+    with pytest.raises(TypeError):
+        copy.remove(1)
+
+
+def test_lookup_matches_brute_force():
+    rng = random.Random(27)
+    index, intervals = ThresholdIndex(), {}
+    for key in range(500):
+        low = rng.choice([float('-inf'), rng.randint(-50, 50) / 2])
+        high = rng.choice([float('inf'), low + rng.randint(0, 40) / 2])
+        bounds = (low, high, rng.random() < 0.5, rng.random() < 0.5)
+        intervals[key] = bounds
+        index.add(key, *bounds)
+    for key in rng.sample(sorted(intervals), 100):
+        del intervals[key]
+        index.remove(key)
+    for value in [rng.randint(-60, 60) / 4 for _ in range(400)] + [float('inf'), float('-inf')]:
+        assert sorted(index.lookup(value)) == brute_force(intervals, value)
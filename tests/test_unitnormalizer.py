@@ -0,0 +1,35 @@
+from compiledrulebase import CompiledRulebase
+from ruleaggregator import RuleAggregator
+from unitnormalizer import UnitNormalizer, UNKNOWN_PARAMETER
+
+MAPPINGS = {
+    'eosinophil': {'names': ['Eosinophil count', 'EOS'], 'units': ['10^3/ul']},
+    'eosinophil_percentage': {'names': ['Eosinophil count', 'EOS %'], 'units': ['%']},
+}
+
+
+def test_ambiguous_alias_is_left_unresolved():
+    normalizer = UnitNormalizer(MAPPINGS)
+    assert normalizer.ambiguous_names == ['eosinophil count']
+    assert normalizer.parameter_id('Eosinophil count') == UNKNOWN_PARAMETER
+    assert normalizer.parameter_id('EOS') == normalizer.parameter_id('eosinophil')
+    assert normalizer.parameter_id('EOS %') == normalizer.parameter_id('eosinophil_percentage')
+
+
+def test_ambiguous_alias_matches_its_own_name_only():
+    normalizer = UnitNormalizer(MAPPINGS)
+    rule = RuleAggregator.from_dict({
+        '_id': 'r1', 'category': 'c', 'disease_name': 'd', 'disease_code': 'D',
+        'rules': [{'rule_id': 1, 'conditions': [{
+            'type': 'range', 'parameter': 'Eosinophil count', 'unit': '10^3/ul', 'age_min': 0, 'age_max': 150,
+            'gender': 'all', 'min_value': 0.5, 'max_value': 2.0}]}]
+    })
+    compiled = CompiledRulebase([rule], normalizer)
+
+    def lab_value(name, value):
+        return [{'parameter_name': name, 'value': value, 'unit': '10^3/ul', 'valid_until': '2999-01-01',
+                 'time': '2024-01-01'}]
+
+    assert compiled.match(40, 'male', lab_value('Eosinophil count', 1.0)) == [rule]
+    assert compiled.match(40, 'male', lab_value('eosinophil_percentage', 1.0)) == []
+    assert compiled.match(40, 'male', lab_value('eosinophil', 1.0)) == []
@@ -0,0 +1,182 @@
+import math
+
+
+class ThresholdIndex:
+    """
+    Centered interval tree over the intervals of all range and comparison
+    conditions on one parameter.
+
+    Open bounds are turned into closed ones with math.nextafter, so every
+    interval is stored as [low, high]. Each tree node holds a center point and
+    the intervals containing it, once sorted by ascending low and once by
+    descending high; intervals entirely below or above the center go to the
+    left or right subtree. A lookup walks one root-to-leaf path and reads only
+    matching intervals from each node: O(log k + matches) time and O(k) space.
+
+    The tree is stored as flat arrays (see ARRAYS), so a built index can be
+    written to and read back from a rulebase snapshot without conversion.
+    """
+
+    # Names and array() typecodes of the flat arrays returned by arrays()
+    ARRAYS = (
+        ('centers', 'd'),       # Center point of every node
+        ('lefts', 'q'),         # Left child of every node, -1 if none
+        ('rights', 'q'),        # Right child of every node, -1 if none
+        ('node_offsets', 'q'),  # Start of every node's intervals in the lists below, plus the end
+        ('lows', 'd'),          # Lower bounds, ascending within each node
+        ('low_keys', 'i'),      # Keys in the order of lows
+        ('highs', 'd'),         # Upper bounds, descending within each node
+        ('high_keys', 'i'),     # Keys in the order of highs
+    )
+
+    def __init__(self):
+        """
+        Initializes an empty ThresholdIndex.
+        """
+        self._intervals = {}
+        self._arrays = tuple([] for _ in self.ARRAYS)
+        self._arrays[3].append(0)
+        self._dirty = False
+
+    @classmethod
+    def from_arrays(cls, *arrays):
+        """
+        Creates a read-only ThresholdIndex over prebuilt arrays, e.g. memoryviews
+        of a rulebase snapshot.
+
+        :param arrays: The arrays named in ARRAYS, in that order.
+        :return: ThresholdIndex instance.
+        """
+        index = cls()
+        index._intervals = None
+        index._arrays = arrays
+        return index
+
+    def __len__(self):
+        if self._intervals is None:
+            return len(self._arrays[5])
+        return len(self._intervals)
+
+    def add(self, key, low, high, low_inclusive=True, high_inclusive=True):
+        """
+        Adds an interval to the index.
+
+        :param key: Integer key returned by lookup when the interval matches.
+        :param low: Lower bound (may be -inf).
+        :param high: Upper bound (may be inf).
+        :param low_inclusive: Whether the lower bound itself matches.
+        :param high_inclusive: Whether the upper bound itself matches.
+        :raises TypeError: If the index is read-only.
+        """
+        if self._intervals is None:
+            raise TypeError("ThresholdIndex built from arrays is read-only")
+        low, high = float(low), float(high)
+        if not low_inclusive:
+            low = math.nextafter(low, math.inf)
+        if not high_inclusive:
+            high = math.nextafter(high, -math.inf)
+        if (not low_inclusive and low == math.inf) or (not high_inclusive and high == -math.inf):
+            low, high = math.inf, -math.inf  # An open bound at infinity leaves nothing to match
+        self._intervals[key] = (low, high)
+        self._dirty = True
+
+    def remove(self, key):
+        """
+        Removes an interval from the index.
+
+        :param key: Key the interval was added with.
+        :raises TypeError: If the index is read-only.
+        """
+        if self._intervals is None:
+            raise TypeError("ThresholdIndex built from arrays is read-only")
+        if self._intervals.pop(key, None) is not None:
+            self._dirty = True
+
+    def build(self):
+        """
+        Rebuilds the tree in O(k log k). Called lazily by lookup after changes.
+        """
+        if self._intervals is None:
+            return
+        arrays = tuple([] for _ in self.ARRAYS)
+        centers, lefts, rights, node_offsets, lows, low_keys, highs, high_keys = arrays
+        node_offsets.append(0)
+
+        def build_node(intervals):
+            if not intervals:
+                return -1
+            # The median bound lies in the interval it bounds, so every node keeps at least one interval
+            bounds = sorted(bound for low, high, _ in intervals for bound in (low, high))
+            center = bounds[len(bounds) // 2]
+            here, below, above = [], [], []
+            for interval in intervals:
+                if interval[1] < center:
+                    below.append(interval)
+                elif interval[0] > center:
+                    above.append(interval)
+                else:
+                    here.append(interval)
+
+            node = len(centers)
+            centers.append(center)
+            lefts.append(-1)
+            rights.append(-1)
+            for low, _, key in sorted(here):
+                lows.append(low)
+                low_keys.append(key)
+            for _, high, key in sorted(here, key=lambda interval: (-interval[1], interval[2])):
+                highs.append(high)
+                high_keys.append(key)
+            node_offsets.append(len(lows))
+            lefts[node] = build_node(below)
+            rights[node] = build_node(above)
+            return node
+
+        # Empty intervals (e.g. an open bound next to an equal closed one) never match
+        build_node([(low, high, key) for key, (low, high) in self._intervals.items() if low <= high])
+        self._arrays = arrays
+        self._dirty = False
+
+    def arrays(self):
+        """
+        Returns the built index as flat arrays, as accepted by from_arrays.
+
+        :return: Tuple of the arrays named in ARRAYS.
+        """
+        if self._dirty:
+            self.build()
+        return self._arrays
+
+    def lookup(self, value):
+        """
+        Returns the keys of all intervals containing the value.
+
+        :param value: Lab value to look up.
+        :return: List of matching keys.
+        """
+        if self._dirty:
+            self.build()
+        matches = []
+        if value != value:  # NaN never satisfies a bound
+            return matches
+        centers, lefts, rights, node_offsets, lows, low_keys, highs, high_keys = self._arrays
+        node = 0 if len(centers) else -1
+        while node != -1:
+            center = centers[node]
+            start, end = node_offsets[node], node_offsets[node + 1]
+            if value < center:
+                for i in range(start, end):
+                    if lows[i] > value:
+                        break
+                    matches.append(low_keys[i])
+                node = lefts[node]
+            elif value > center:
+                for i in range(start, end):
+                    if highs[i] < value:
+                        break
+                    matches.append(high_keys[i])
+                node = rights[node]
+            else:
+                matches.extend(low_keys[start:end])
+                break
+        return matches
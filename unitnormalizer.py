@@ -0,0 +1,253 @@
+import json
+import logging
+import os
+import threading
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Parameter ID returned for names that no compiled rule uses
+UNKNOWN_PARAMETER = -1
+
+MAPPINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'mappings.json')
+
+# Spellings that carry no unit information
+UNSPECIFIED_UNITS = {'', 'na', 'n/a', '-', '.', '""', '---units---', 'units', 'calc'}
+
+# Alternative spellings of the same unit, mapped to one canonical spelling
+UNIT_ALIASES = {
+    'iu/l': 'u/l',
+    'mg/ dl': 'mg/dl', 'mg / dl': 'mg/dl', 'mg%': 'mg/dl',
+    'gm/dl': 'g/dl',
+    'mcg/dl': 'ug/dl',
+    'mcg/mg creat': 'ug/mg',
+    'umol/l': 'µmol/l', 'μmol/l': 'µmol/l',
+    'x10e3/ul': '10^3/ul', '10*3/âμl': '10^3/ul', '10^3': '10^3/ul', 'k/?l': '10^3/ul',
+    'x10e3/?l': '10^3/ul', 'x10?/ul': '10^3/ul', '10(3)': '10^3/ul', 'x10e3/mm3': '10^3/ul',
+    'x 10^9/l': '10^3/ul',
+    'million/ul': '10^6/ul', 'x10e6/ul': '10^6/ul', 'x10e6/?l': '10^6/ul', '10:6/ul': '10^6/ul',
+    '10^6': '10^6/ul', 'x10^6/mcl': '10^6/ul', '10^6ul': '10^6/ul',
+    '/ hpf': '/hpf',
+    '/100 wbcs': '/100 wbc', 'per 100 wbc': '/100 wbc',
+    'mm/hour': 'mm/hr',
+    'cu um': 'fl', 'ƒl': 'fl', 'μm^3': 'fl', 'um^3': 'fl',
+    'pg/cell': 'pg', 'pg.': 'pg', 'picogram': 'pg',
+    'mcinu/ml': 'uiu/ml', 'âμu/ml': 'uiu/ml',
+    '{titer}': 'titer',
+    '%.0': '%',
+    'ph units': 'ph', 'sg units': 'sg',
+}
+
+# Canonical units that can be converted into each other: unit -> (dimension, factor to the dimension's base unit)
+UNIT_FACTORS = {
+    'mg/dl': ('mass', 1.0),
+    'g/dl': ('mass', 1000.0),
+    'g/l': ('mass', 100.0),
+    'mg/l': ('mass', 0.1),
+    'ug/dl': ('mass', 0.001),
+    'ng/ml': ('mass', 0.0001),
+    'ng/dl': ('mass', 0.000001),
+    'pg/ml': ('mass', 0.0000001),
+    'mmol/l': ('substance', 1.0),
+    'µmol/l': ('substance', 0.001),
+    'nmol/l': ('substance', 0.000001),
+    'u/l': ('activity', 1.0),
+    'ku/l': ('activity', 1000.0),
+    'iu/ml': ('activity', 1000.0),
+    '10^3/ul': ('count', 1.0),
+    '10^6/ul': ('count', 1000.0),
+    'cells/ul': ('count', 0.001),
+    'ug/mg': ('ratio', 1.0),
+    'mg/g': ('ratio', 1.0),
+}
+
+
+class UnitNormalizer:
+    """
+    Maps parameter names and units onto canonical integer IDs and canonical units.
+
+    Parameter IDs are assigned in the order of mappings.json; every parameter key
+    and every entry of its 'names' list resolves to the same ID. Names missing
+    from mappings.json get an ID only when a rule using them is compiled
+    (register_parameter); looking up any other name returns UNKNOWN_PARAMETER,
+    so lab input never grows the tables. An alias listed under more than one
+    parameter (e.g. 'Eosinophil count' under both the absolute count and the
+    percentage) is ambiguous and left unresolved: it only matches rules and lab
+    values using the very same name, as before names were mapped. The canonical
+    unit of a parameter is the first unit listed for it. Conversion factors from
+    every listed unit to the canonical unit are precomputed; units without a
+    known conversion keep their value unchanged, as the evaluator always did.
+    """
+
+    _default = None
+
+    def __init__(self, mappings):
+        """
+        Initializes the UnitNormalizer from the parsed mappings.json content.
+
+        :param mappings: Dictionary of parameter key -> {'names': [...], 'units': [...]}.
+        """
+        self._parameter_ids = {}
+        self._parameter_names = []
+        self._canonical_units = []
+        self._factors = {}
+        self._listed_units = {}
+        self._lock = threading.Lock()
+
+        parameters = {key: mapping for key, mapping in mappings.items() if not key.startswith('----')}
+        for key, mapping in parameters.items():
+            units = mapping.get('units', [])
+            parameter_id = self.register_parameter(key)
+            self._canonical_units[parameter_id] = self.canonical_unit(units[0] if units else None)
+        owners = {}
+        for key, mapping in parameters.items():
+            parameter_id = self.parameter_id(key)
+            for name in mapping.get('names', []):
+                owners.setdefault(name.lower(), set()).add(parameter_id)
+            self._listed_units[parameter_id] = mapping.get('units', [])
+            for unit in mapping.get('units', []):
+                self.factor(parameter_id, unit)
+
+        # Parameter keys keep their own ID; other names only resolve if a single parameter lists them
+        self.ambiguous_names = sorted(name for name, parameter_ids in owners.items()
+                                      if len(parameter_ids) > 1 and name not in self._parameter_ids)
+        for name, parameter_ids in owners.items():
+            if len(parameter_ids) == 1:
+                self._parameter_ids.setdefault(name, next(iter(parameter_ids)))
+        if self.ambiguous_names:
+            logging.warning(f"Parameter names listed under several parameters are left unresolved: "
+                            f"{', '.join(self.ambiguous_names)}")
+
+    @classmethod
+    def from_file(cls, path=MAPPINGS_PATH):
+        """
+        Creates a UnitNormalizer from a mappings.json file.
+
+        :param path: Path of the mappings file.
+        :return: UnitNormalizer instance.
+        """
+        with open(path, 'r') as mappings_file:
+            return cls(json.load(mappings_file))
+
+    @classmethod
+    def default(cls):
+        """
+        Returns the process-wide UnitNormalizer built from static/mappings.json.
+
+        :return: UnitNormalizer instance.
+        """
+        if cls._default is None:
+            cls._default = cls.from_file()
+        return cls._default
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def parameter_id(self, name):
+        """
+        Resolves a parameter key or alias to its ID without registering anything.
+
+        :param name: Parameter name as stored in a rule or lab value.
+        :return: Integer parameter ID, or UNKNOWN_PARAMETER if the name is not registered.
+        """
+        parameter_id = self._parameter_ids.get(name)
+        if parameter_id is None:
+            parameter_id = self._parameter_ids.get(name.lower(), UNKNOWN_PARAMETER)
+        return parameter_id
+
+    def register_parameter(self, name):
+        """
+        Resolves a parameter key or alias to its ID, assigning a new ID to unknown
+        names. Only called when compiling rules, so the number of IDs is bounded
+        by the rulebase.
+
+        :param name: Parameter name as stored in a rule.
+        :return: Integer parameter ID.
+        """
+        parameter_id = self.parameter_id(name)
+        if parameter_id != UNKNOWN_PARAMETER:
+            return parameter_id
+        with self._lock:
+            lowered = name.lower()
+            parameter_id = self._parameter_ids.get(lowered)
+            if parameter_id is None:
+                parameter_id = len(self._parameter_names)
+                self._parameter_names.append(name)
+                self._canonical_units.append(None)
+                self._parameter_ids[lowered] = parameter_id
+            self._parameter_ids[name] = parameter_id
+        return parameter_id
+
+    def parameter_name(self, parameter_id):
+        """
+        :param parameter_id: Integer parameter ID.
+        :return: The parameter key the ID was first assigned to.
+        """
+        return self._parameter_names[parameter_id]
+
+    def spellings(self, parameter_id):
+        """
+        Returns every known spelling of a parameter's name and units.
+
+        :param parameter_id: Integer parameter ID.
+        :return: Tuple (sorted list of names, list of units listed in mappings.json).
+        """
+        names = sorted({name for name, known_id in self._parameter_ids.items() if known_id == parameter_id})
+        return names, self._listed_units.get(parameter_id, [])
+
+    @staticmethod
+    def canonical_unit(unit):
+        """
+        Normalizes a unit spelling.
+
+        :param unit: Unit as written in mappings.json, a rule or a lab value.
+        :return: Canonical unit spelling, or None if the unit is unspecified.
+        """
+        if unit is None:
+            return None
+        unit = unit.strip().lower()
+        if unit in UNSPECIFIED_UNITS:
+            return None
+        return UNIT_ALIASES.get(unit, unit)
+
+    def factor(self, parameter_id, unit):
+        """
+        Returns the factor converting values of the parameter from the unit into
+        the parameter's canonical unit. Results are cached per (parameter, unit).
+
+        :param parameter_id: Integer parameter ID.
+        :param unit: Unit spelling.
+        :return: Conversion factor (1.0 if no conversion is known).
+        """
+        key = (parameter_id, unit)
+        factor = self._factors.get(key)
+        if factor is None:
+            factor = 1.0
+            source = UNIT_FACTORS.get(self.canonical_unit(unit))
+            if source is None or parameter_id == UNKNOWN_PARAMETER:
+                return factor  # Not cached, so unknown spellings from lab input do not grow the cache
+            target = UNIT_FACTORS.get(self._canonical_units[parameter_id])
+            if target and source[0] == target[0]:
+                factor = source[1] / target[1]
+            self._factors[key] = factor
+        return factor
+
+    def convert(self, parameter_id, unit, value):
+        """
+        Converts a value of the parameter into the parameter's canonical unit.
+
+        :param parameter_id: Integer parameter ID.
+        :param unit: Unit spelling of the value.
+        :param value: Numeric value.
+        :return: Value in the canonical unit.
+        """
+        factor = self.factor(parameter_id, unit)
+        if factor == 1.0:
+            return value
+        return float(f'{value * factor:.12g}')